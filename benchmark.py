@@ -0,0 +1,514 @@
+"""
+Offline load test of handle_message. Starts local stand-ins for the OpenAI chat endpoint, the Telegram Bot API and
+Telegraph, replaces the pyrogram client with a stub, and drives handle_message with synthetic messages.
+
+Usage:
+    python benchmark.py                       # run the scenarios and compare with the stored baseline
+    python benchmark.py --save-baseline       # run the scenarios and store the results as the new baseline
+    python benchmark.py --depths 0 10 --function-calls 0 2 --chats 1 20 --requests 5
+    python benchmark.py --long-answer-words 500  # longer streamed answer in the time to first output scenario
+    python benchmark.py --redaction           # micro-benchmark of the secret redaction
+    python benchmark.py --openai-error-rate 0.1 --openai-stall-rate 0.05 --attempt-timeout 2 --hedging
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import tempfile
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from aiohttp import web
+import openai
+from pyrogram.enums import ChatMemberStatus, ChatType, MessageEntityType
+from pyrogram.types import Chat, Message, MessageEntity, User
+
+import functioncall
+import gpt
+import member_cache
+import message_handler
+import telegraph
+from context_builder import context_builder
+from functioncall import result_cache
+from initialize_app import http_client
+from message_cache import message_cache
+from message_handler import handle_message
+from rate_limits import openai_limiter, send_limiter
+from record_store import records, SQLiteRecordStore
+from redaction import Redactor, REDACTION_MASK
+from resilience import openai_caller, LatencyTracker, CircuitBreaker
+
+
+BASELINE_PATH = "benchmark_baseline.json"
+BOT_USER = User(id=1, is_self=True, is_bot=True, first_name="GPTModerBot")
+ANSWER_TEXT = "Done. The chat has 42 members and the description is updated as you asked."
+
+
+def long_answer(words: int) -> str:
+    """
+    :return: The answer of the given number of words, for the scenario measuring the time to the first output.
+    """
+    answer_words = ANSWER_TEXT.split(" ")
+    return " ".join((answer_words * (words // len(answer_words) + 1))[:words])
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Nearest-rank percentile.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+class StubServers:
+    """
+    Local stand-ins for api.openai.com, api.telegram.org and api.telegra.ph with configurable latency.
+    The OpenAI stand-in answers with function_calls rounds of tool calls, then with the text answer. A share of its
+    responses can be 429 errors with Retry-After (error_rate) or stalls of stall_seconds (stall_rate): before
+    the response or, for the streams, after the first chunk.
+    """
+    def __init__(self, function_calls: int, openai_latency: float, token_interval: float,
+                 telegram_latency: float, telegraph_latency: float, error_rate: float = 0.0, stall_rate: float = 0.0,
+                 stall_seconds: float = 60.0, answer_text: str = ANSWER_TEXT):
+        self.function_calls = function_calls
+        self.answer_text = answer_text
+        self.openai_latency = openai_latency
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.stopping = None
+        self.token_interval = token_interval
+        self.telegram_latency = telegram_latency
+        self.telegraph_latency = telegraph_latency
+        self.calls = Counter()
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        self.stopping = asyncio.Event()
+        application = web.Application()
+        application.router.add_post("/v1/chat/completions", self.chat_completions)
+        application.router.add_post("/bot{token}/{method}", self.bot_api)
+        application.router.add_post("/createPage", self.create_page)
+        application.router.add_get("/getPage/{path}", self.get_page)
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        # The stalled responses end with the servers, not after stall_seconds
+        self.stopping.set()
+        await self.runner.cleanup()
+
+    async def stall(self):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), self.stall_seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def next_tool_call(self, messages: list):
+        """
+        :return: The tool call of the next round or None, when it is time to answer.
+        """
+        last_user = max(i for i, context_message in enumerate(messages) if context_message["role"] == "user")
+        rounds = sum(1 for context_message in messages[last_user:] if context_message.get("tool_calls"))
+        if rounds >= self.function_calls:
+            return None
+        if rounds % 2:
+            name, arguments = "setChatDescription", json.dumps({"description": f"Benchmark round {rounds}"})
+        else:
+            name, arguments = "getChatMemberCount", "{}"
+        return {"id": f"call_{rounds}", "type": "function", "function": {"name": name, "arguments": arguments}}
+
+    async def chat_completions(self, request):
+        self.calls["openai"] += 1
+        body = await request.json()
+        await asyncio.sleep(self.openai_latency)
+        tool_call = self.next_tool_call(body["messages"]) if body.get("tools") else None
+
+        roll = random.random()
+        if roll < self.error_rate:
+            self.calls["openai_injected_errors"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached (benchmark)", "type": "requests"}},
+                                     status=429, headers={"Retry-After": "0.1"})
+        stall = roll < self.error_rate + self.stall_rate
+        if stall:
+            self.calls["openai_injected_stalls"] += 1
+
+        if not body.get("stream"):
+            if stall:
+                await self.stall()
+            message = {"role": "assistant", "content": None if tool_call else self.answer_text}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            return web.json_response({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: str = None):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body["model"], "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        if tool_call:
+            await send({"role": "assistant", "tool_calls": [{"index": 0, **tool_call}]})
+            if stall:
+                await self.stall()
+            await send({}, "tool_calls")
+        else:
+            for word in self.answer_text.split(" "):
+                await send({"content": word + " "})
+                if stall:
+                    await self.stall()
+                await asyncio.sleep(self.token_interval)
+            await send({}, "stop")
+        if body.get("stream_options", {}).get("include_usage"):
+            usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+            await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def bot_api(self, request):
+        self.calls["bot_api"] += 1
+        await asyncio.sleep(self.telegram_latency)
+        return web.json_response({"ok": True, "result": 42 if request.match_info["method"] == "getChatMemberCount" else True})
+
+    async def create_page(self, request):
+        self.calls["telegraph"] += 1
+        await asyncio.sleep(self.telegraph_latency)
+        return web.json_response({"ok": True, "result": {"url": f"https://telegra.ph/Bench-{self.calls['telegraph']}"}})
+
+    async def get_page(self, request):
+        self.calls["telegraph"] += 1
+        await asyncio.sleep(self.telegraph_latency)
+        content = 'getChatMemberCount\n\n{}\n\n{"ok": true, "result": 42}'
+        return web.json_response({"ok": True, "result": {"content": [content]}})
+
+
+class StubClient:
+    """
+    Stand-in for the pyrogram client: keeps the synthetic chats in memory and answers with mtproto_latency.
+    """
+    def __init__(self, mtproto_latency: float):
+        self.mtproto_latency = mtproto_latency
+        # {chat_id: {message_id: (from_user, text, reply_to_message_id, entities)}}
+        self.chats = defaultdict(dict)
+        self.next_ids = defaultdict(lambda: 1)
+        self.calls = Counter()
+        # {(chat_id, message_id): time the first answer part was sent}
+        self.first_sent = {}
+        # {(chat_id, message_id): id of the answer message}
+        self.answers = {}
+
+    def add_message(self, chat_id: int, from_user: User, text: str, reply_to_message_id: int = None,
+                    entities: list = None) -> int:
+        message_id = self.next_ids[chat_id]
+        self.next_ids[chat_id] += 1
+        self.chats[chat_id][message_id] = (from_user, text, reply_to_message_id, entities)
+        return message_id
+
+    def build_message(self, chat_id: int, message_id: int, replies: int = 0) -> Message:
+        """
+        Builds the pyrogram message like pyrogram does: with replies levels of replied messages fetched.
+        """
+        from_user, text, reply_to_message_id, entities = self.chats[chat_id][message_id]
+        reply_to_message = None
+        if reply_to_message_id and replies:
+            reply_to_message = self.build_message(chat_id, reply_to_message_id, replies - 1)
+        return Message(
+            client=self, id=message_id, chat=Chat(id=chat_id, type=ChatType.SUPERGROUP), from_user=from_user,
+            text=text, entities=entities, reply_to_message_id=reply_to_message_id, reply_to_message=reply_to_message
+        )
+
+    async def get_messages(self, chat_id: int, message_ids: int, replies: int = 1):
+        message = self.build_message(chat_id, message_ids, len(self.chats[chat_id]) if replies < 0 else replies)
+        # Pyrogram fetches each level of the replies with its own request
+        reply = message
+        while reply:
+            self.calls["get_messages"] += 1
+            await asyncio.sleep(self.mtproto_latency)
+            reply = reply.reply_to_message
+        return message
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        self.calls["get_chat_member"] += 1
+        await asyncio.sleep(self.mtproto_latency)
+        return SimpleNamespace(status=ChatMemberStatus.ADMINISTRATOR, user=SimpleNamespace(id=user_id))
+
+    async def get_chat_members(self, chat_id: int, filter=None):
+        self.calls["get_chat_members"] += 1
+        await asyncio.sleep(self.mtproto_latency)
+        for user_id in (1, 2):
+            yield SimpleNamespace(status=ChatMemberStatus.ADMINISTRATOR, user=SimpleNamespace(id=user_id))
+
+    async def send_message(self, chat_id: int, text: str, reply_to_message_id: int = None, **kwargs):
+        self.calls["send_message"] += 1
+        await asyncio.sleep(self.mtproto_latency)
+        self.first_sent.setdefault((chat_id, reply_to_message_id), time.perf_counter())
+        message_id = self.add_message(chat_id, BOT_USER, text, reply_to_message_id)
+        self.answers[(chat_id, reply_to_message_id)] = message_id
+        return self.build_message(chat_id, message_id)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs):
+        self.calls["edit_message_text"] += 1
+        await asyncio.sleep(self.mtproto_latency)
+        from_user, _, reply_to_message_id, entities = self.chats[chat_id][message_id]
+        self.chats[chat_id][message_id] = (from_user, text, reply_to_message_id, entities)
+        return self.build_message(chat_id, message_id)
+
+
+def build_chain(client: StubClient, chat_id: int, depth: int) -> int:
+    """
+    Builds a reply chain of depth messages, alternating users and the bot. Every bot message links a function call
+    record on Telegraph.
+    :return: The id of the last message of the chain, None for depth 0.
+    """
+    last_id = None
+    for i in range(depth):
+        if i % 2:
+            entities = [MessageEntity(type=MessageEntityType.TEXT_LINK, offset=0, length=1,
+                                      url=f"https://telegra.ph/Bench-{chat_id}-{i}")]
+            last_id = client.add_message(chat_id, BOT_USER, f"‎ The chat has 42 members ({i}).", last_id, entities)
+        else:
+            user = User(id=1000 + chat_id, is_self=False, first_name="User")
+            last_id = client.add_message(chat_id, user, f"gptm how many members are there? ({i})", last_id)
+    return last_id
+
+
+def check_cached_answer(client: StubClient, chat_id: int, message_id: int):
+    """
+    Checks, that the cached answer message has the final text sent to the chat, not a part of the streamed answer.
+    Later reply chains are rebuilt from the cached messages.
+    """
+    answer_id = client.answers[(chat_id, message_id)]
+    cached_text = message_cache.chats[chat_id][answer_id].text
+    sent_text = client.chats[chat_id][answer_id][1]
+    assert cached_text == sent_text, f"The cached answer {cached_text!r} differs from the sent one {sent_text!r}"
+
+
+def reset_state():
+    """
+    Resets all the caches, so every scenario starts cold.
+    """
+    message_cache.chats.clear()
+    telegraph.telegraph_cache.pages.clear()
+    member_cache.member_cache.statuses.clear()
+    member_cache.member_cache.prewarmed_chats.clear()
+    result_cache.results.clear()
+    context_builder.counter.counts.clear()
+    openai_caller.latency = LatencyTracker()
+    openai_caller.breaker = CircuitBreaker()
+    for counter in (openai_caller.retries, openai_caller.hedges, openai_caller.failures, openai_caller.fallbacks):
+        counter.values.clear()
+
+
+def disable_rate_limits():
+    """
+    The local stand-ins have no rate limits, the budgets would only add waiting to the measurements.
+    """
+    for bucket in (openai_limiter.requests, openai_limiter.tokens, send_limiter.total):
+        bucket.rate = bucket.capacity = bucket.tokens = 1e12
+    send_limiter.per_minute_per_chat = 1e12
+    send_limiter.chats.clear()
+
+
+async def run_scenario(args, depth: int, function_calls: int, chats: int, answer_text: str = ANSWER_TEXT) -> dict:
+    servers = StubServers(function_calls, args.openai_latency, args.token_interval,
+                          args.telegram_latency, args.telegraph_latency,
+                          args.openai_error_rate, args.openai_stall_rate, args.openai_stall_seconds, answer_text)
+    await servers.start()
+    client = StubClient(args.telegram_latency)
+
+    # Pointing all the outbound calls to the local stand-ins
+    openai.api_base = f"{servers.url}/v1"
+    functioncall.TELEGRAM_API_URL = servers.url
+    telegraph.TELEGRAPH_API_URL = servers.url
+    gpt.app = client
+    member_cache.app = client
+    message_handler.STREAM_REPLIES = args.stream
+    openai_caller.attempt_timeout = args.attempt_timeout
+    openai_caller.hedging = args.hedging
+    reset_state()
+    disable_rate_limits()
+
+    chat_ids = list(range(1, chats + 1))
+    chain_tips = {chat_id: build_chain(client, chat_id, depth) for chat_id in chat_ids}
+    latencies, first_output = [], []
+
+    async def run_chat(chat_id: int):
+        user = User(id=1000 + chat_id, is_self=False, first_name="User")
+        for _ in range(args.requests):
+            message_id = client.add_message(chat_id, user, "gptm count the members and update the description",
+                                            chain_tips[chat_id])
+            message = client.build_message(chat_id, message_id, replies=1)
+            start = time.perf_counter()
+            await handle_message(client, message)
+            latencies.append(time.perf_counter() - start)
+            check_cached_answer(client, chat_id, message_id)
+            first_output.append(client.first_sent.get((chat_id, message_id), time.perf_counter()) - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_chat(chat_id) for chat_id in chat_ids))
+    wall_time = time.perf_counter() - start
+    await servers.stop()
+
+    requests_count = len(latencies)
+    injected = {name: count for name, count in servers.calls.items() if name.startswith("openai_injected")}
+    outbound = sum(servers.calls.values()) - sum(injected.values()) + sum(client.calls.values())
+    return {
+        "requests": requests_count,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "first_output_p50_ms": percentile(first_output, 50) * 1000,
+        "rps": requests_count / wall_time,
+        "outbound_per_request": outbound / requests_count,
+        "outbound": dict(servers.calls + client.calls),
+        "openai_retries": sum(openai_caller.retries.values.values()),
+        "openai_hedges": sum(openai_caller.hedges.values.values()),
+        "openai_failures": sum(openai_caller.failures.values.values()),
+    }
+
+
+def compare(results: dict, baseline: dict):
+    print("\nCompared with the baseline (negative is better for latency and outbound calls, positive for rps):")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        deltas = []
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "rps", "outbound_per_request"):
+            before = baseline[name][metric]
+            deltas.append(f"{metric} {(result[metric] - before) / before * 100:+.1f}%" if before else f"{metric} n/a")
+        print(f"  {name}: " + ", ".join(deltas))
+
+
+async def main(args):
+    # Local records go to a temporary store, not to the bot's one
+    records.sqlite = SQLiteRecordStore(path=os.path.join(tempfile.mkdtemp(), "records.sqlite3"))
+    openai.api_key = "benchmark"
+    openai.aiosession.set(http_client.session)
+
+    # {name: (depth, function calls, chats, answer text)}
+    scenarios = {
+        f"depth={depth} calls={function_calls} chats={chats}": (depth, function_calls, chats, ANSWER_TEXT)
+        for depth in args.depths for function_calls in args.function_calls for chats in args.chats
+    }
+    if args.long_answer_words:
+        # The streamed reply is sent with the first tokens, so the first output comes long before the answer ends
+        scenarios[f"long answer words={args.long_answer_words}"] = (0, 0, 1, long_answer(args.long_answer_words))
+
+    results = {}
+    try:
+        for name, (depth, function_calls, chats, answer_text) in scenarios.items():
+            result = results[name] = await run_scenario(args, depth, function_calls, chats, answer_text)
+            print(f"{name}: p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+                  f"p99 {result['p99_ms']:.1f} ms, first output p50 {result['first_output_p50_ms']:.1f} ms, "
+                  f"{result['rps']:.1f} rps, {result['outbound_per_request']:.1f} outbound calls/request"
+                  + (f", OpenAI retries {result['openai_retries']:.0f}, hedges {result['openai_hedges']:.0f}, "
+                     f"failures {result['openai_failures']:.0f}"
+                     if args.openai_error_rate or args.openai_stall_rate else ""))
+    finally:
+        await http_client.close()
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+def redaction_case(secrets_count: int, text_length: int):
+    """
+    :return: The secrets and a random text of text_length characters with some of the secrets in it.
+    """
+    alphabet = string.ascii_letters + string.digits
+    secrets = [''.join(random.choices(alphabet, k=32)) for _ in range(secrets_count)]
+    words = [''.join(random.choices(alphabet, k=random.randint(3, 12))) for _ in range(text_length // 7)]
+    words[::1000] = random.choices(secrets, k=len(words[::1000]))
+    return secrets, ' '.join(words)[:text_length]
+
+
+def benchmark_redaction(secret_counts: tuple = (10, 100, 1000, 10000), text_lengths: tuple = (50_000, 200_000, 800_000)):
+    """
+    Compares the compiled single-pass redaction with one str.replace per secret. The time per character of the
+    compiled redaction doesn't depend on the text length and is bounded by the trie fan-out, not by the number of
+    secrets, while the str.replace loop grows with every secret.
+    """
+    print("Growing secrets list, 200 KB text:")
+    for count in secret_counts:
+        secrets, text = redaction_case(count, 200_000)
+
+        start = time.perf_counter()
+        redactor = Redactor(secrets)
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        redacted = redactor.redact(text)
+        compiled_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        replaced = text
+        for secret in secrets:
+            replaced = replaced.replace(secret, REDACTION_MASK)
+        replace_time = time.perf_counter() - start
+
+        assert redacted == replaced
+        print(f"  {count:>6} secrets: compiled {compiled_time * 1e9 / len(text):.1f} ns/char "
+              f"(compiled once in {compile_time * 1000:.1f} ms), "
+              f"str.replace loop {replace_time * 1e9 / len(text):.1f} ns/char")
+
+    print("Growing text, 1000 secrets:")
+    for length in text_lengths:
+        secrets, text = redaction_case(1000, length)
+        redactor = Redactor(secrets)
+        start = time.perf_counter()
+        redactor.redact(text)
+        print(f"  {length // 1000:>6} KB: compiled {(time.perf_counter() - start) * 1e9 / len(text):.1f} ns/char")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test of handle_message")
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 4, 16], help="Reply chain depths")
+    parser.add_argument("--function-calls", type=int, nargs="+", default=[0, 2], help="Function call rounds per request")
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 20], help="Numbers of concurrent chats")
+    parser.add_argument("--requests", type=int, default=5, help="Requests per chat")
+    parser.add_argument("--long-answer-words", type=int, default=200,
+                        help="Words of the streamed answer in the time to first output scenario, 0 to skip it")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="Seconds to the first OpenAI response byte")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Seconds between streamed tokens")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="Seconds per Telegram call")
+    parser.add_argument("--telegraph-latency", type=float, default=0.1, help="Seconds per Telegraph call")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="Disable streamed replies")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0,
+                        help="Share of OpenAI responses replaced with 429 errors")
+    parser.add_argument("--openai-stall-rate", type=float, default=0.0, help="Share of OpenAI responses that stall")
+    parser.add_argument("--openai-stall-seconds", type=float, default=60.0, help="Seconds a stalled response hangs")
+    parser.add_argument("--attempt-timeout", type=float, default=openai_caller.attempt_timeout,
+                        help="Seconds one OpenAI attempt may take")
+    parser.add_argument("--hedging", action="store_true", help="Hedge the slow non-streamed OpenAI requests")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Path of the stored baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--redaction", action="store_true", help="Run the redaction micro-benchmark only")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.redaction:
+        benchmark_redaction()
+    else:
+        asyncio.run(main(arguments))
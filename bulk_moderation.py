@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+from collections import Counter
+from pyrogram.types import Message
+from initialize_app import http_client
+from record_store import records
+from message_cache import message_cache
+from rate_limits import send_limiter
+from redaction import redactor
+from metrics import metrics
+from resilience import attempt_timeout, request_deadline
+
+
+# Max number of Telegram API requests of one bulk job running at the same time
+BULK_CONCURRENCY = 5
+# Max number of users or messages one bulk function call can target
+BULK_MAX_TARGETS = 1000
+# deleteMessages accepts at most 100 message ids
+DELETE_MESSAGES_CHUNK = 100
+# Max number of retries of one request answered with 429 Too Many Requests
+BULK_MAX_RETRIES = 5
+# Seconds the function call waits for the job, at most until the request deadline. A longer job goes on
+# in the background and posts its summary itself
+BULK_JOB_WAIT = 10
+# Max number of failed targets listed in the summary
+SUMMARY_FAILED_TARGETS = 20
+
+logger = logging.getLogger(__name__)
+
+
+def ban_requests(params: dict) -> list:
+    extra = {"revoke_messages": params["revoke_messages"]} if "revoke_messages" in params else {}
+    return [("banChatMember", {"user_id": user_id, **extra}, [user_id]) for user_id in params["user_ids"]]
+
+
+def restrict_requests(params: dict) -> list:
+    extra = {"until_date": params["until_date"]} if "until_date" in params else {}
+    return [("restrictChatMember", {"user_id": user_id, "permissions": params["permissions"], **extra}, [user_id])
+            for user_id in params["user_ids"]]
+
+
+def delete_range_requests(params: dict) -> list:
+    message_ids = list(range(params["from_message_id"], params["to_message_id"] + 1))
+    return [("deleteMessages", {"message_ids": chunk}, chunk)
+            for chunk in (message_ids[i:i + DELETE_MESSAGES_CHUNK] for i in range(0, len(message_ids), DELETE_MESSAGES_CHUNK))]
+
+
+def is_detached(result) -> bool:
+    """
+    :return: True if the result is the notice of a job going on in the background, which stores its summary record
+    and invalidates the cached results itself when it finishes.
+    """
+    return isinstance(result, dict) and bool(result.get("detached"))
+
+
+def count_targets(called_function: str, params: dict) -> int:
+    if called_function == "deleteMessagesRange":
+        return params["to_message_id"] - params["from_message_id"] + 1
+    return len(params["user_ids"])
+
+
+# {bulk function: params -> [(Telegram API method, request params, targets), ...]}
+bulk_requests = {
+    'banChatMembers': ban_requests,
+    'restrictChatMembers': restrict_requests,
+    'deleteMessagesRange': delete_range_requests,
+}
+
+
+class BulkJob:
+    """
+    Runs the Telegram API requests of one bulk function call with bounded concurrency. A 429 response pauses
+    the whole job for its retry_after, then the request is retried. The outcome is one summary result.
+    on_finish is called when the detached job finishes, successfully or not.
+    """
+    def __init__(self, called_function: str, params: dict, secure_params: dict, api_url: str, message: Message = None,
+                 concurrency: int = BULK_CONCURRENCY, on_finish=None):
+        self.called_function = called_function
+        self.params = params
+        self.secure_params = secure_params
+        self.api_url = api_url
+        self.message = message
+        self.concurrency = concurrency
+        self.on_finish = on_finish
+        self.succeeded = 0
+        self.failed_targets = []
+        self.errors = Counter()
+        self.retries = 0
+        self._resume = None
+
+    def validate(self) -> str:
+        """
+        :return: The error of the params, which the schema can't express. Empty if they are valid.
+        """
+        if self.called_function not in bulk_requests:
+            return f"{self.called_function} is not a bulk function. "
+        if self.called_function == "deleteMessagesRange" and self.params["to_message_id"] < self.params["from_message_id"]:
+            return "to_message_id must not be less than from_message_id. "
+        if count_targets(self.called_function, self.params) > BULK_MAX_TARGETS:
+            return f"At most {BULK_MAX_TARGETS} targets can be processed at once. "
+        return ''
+
+    async def post(self, method: str, params: dict) -> dict:
+        """
+        Sends one Telegram API request, retrying it after the retry_after of 429 responses.
+        :return: The Telegram API response. Data type: dict.
+        """
+        for _ in range(BULK_MAX_RETRIES + 1):
+            # The requests wait while the job is paused by a 429 response of any of them
+            while self._resume is not None and not self._resume.is_set():
+                await self._resume.wait()
+
+            async with http_client.session.post(f'{self.api_url}/{method}', json={**params, **self.secure_params}) as resp:
+                try:
+                    response = await resp.json(content_type=None)
+                except json.JSONDecodeError:
+                    response = {"ok": False, "error_code": resp.status, "description": f"HTTP error occurred: {resp.status}"}
+            if response.get("error_code") != 429:
+                return response
+
+            self.retries += 1
+            metrics.counter("gptmoder_bulk_retries_total", "Bulk job requests retried after 429, per function.").inc(
+                function=self.called_function)
+            retry_after = (response.get("parameters") or {}).get("retry_after", 1)
+            if self._resume is None or self._resume.is_set():
+                self._resume = asyncio.Event()
+                await asyncio.sleep(retry_after)
+                self._resume.set()
+        return response
+
+    async def run(self) -> dict:
+        """
+        Runs all the requests of the job.
+        :return: The summary result. Data type: dict.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_request(method: str, params: dict, targets: list):
+            async with semaphore:
+                try:
+                    response = await self.post(method, params)
+                except Exception as e:
+                    response = {"ok": False, "description": str(e)}
+            if response.get("ok"):
+                self.succeeded += len(targets)
+            else:
+                self.failed_targets.extend(targets)
+                self.errors[response.get("description") or "Unknown error"] += len(targets)
+
+        with metrics.span("bulk_job", function=self.called_function):
+            await asyncio.gather(*(run_request(*request) for request in bulk_requests[self.called_function](self.params)))
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {
+            "ok": not self.failed_targets,
+            "result": {
+                "succeeded": self.succeeded,
+                "failed": len(self.failed_targets),
+                "errors": dict(self.errors),
+                "failed_targets": self.failed_targets[:SUMMARY_FAILED_TARGETS],
+                "retries_after_429": self.retries
+            }
+        }
+
+    async def run_or_detach(self, wait: float = BULK_JOB_WAIT) -> dict:
+        """
+        Runs the job, waiting for it at most 'wait' seconds and not past the request deadline. If it takes longer,
+        it goes on in the background and posts its summary as a reply to the request message.
+        :return: The summary result or, for the detached job, the notice that it goes on. Data type: dict.
+        """
+        task = asyncio.create_task(self.run())
+        done, _ = await asyncio.wait({task}, timeout=max(0, attempt_timeout(wait)))
+        if done:
+            return task.result()
+
+        summary_task = asyncio.create_task(self.post_summary(task))
+        background_jobs.add(summary_task)
+        summary_task.add_done_callback(background_jobs.discard)
+        return {"ok": True, "detached": True, "result": f"The job is running in the background for "
+                                      f"{count_targets(self.called_function, self.params)} targets, "
+                                      f"the summary will be posted when it finishes."}
+
+    async def post_summary(self, task: asyncio.Task):
+        """
+        Waits for the detached job, stores its summary as a record and replies with it to the request message.
+        The summary outlives the request, so it isn't limited by the request deadline.
+        """
+        with request_deadline(None):
+            await self._post_summary(task)
+
+    async def _post_summary(self, task: asyncio.Task):
+        try:
+            summary = await task
+        except Exception as e:
+            logger.exception("Bulk job %s failed", self.called_function)
+            summary = f"The bulk job failed: {e}"
+        if self.on_finish:
+            self.on_finish()
+        if not self.message:
+            return
+        try:
+            url = await records.write(self.called_function, {**self.params, **self.secure_params}, summary)
+            result = summary["result"] if isinstance(summary, dict) else {}
+            text = (f"{self.called_function} finished: {result.get('succeeded', 0)} succeeded, "
+                    f"{result.get('failed', 0)} failed." if result else summary)
+            await send_limiter.acquire(self.message.chat.id)
+            answer_message = await self.message.reply(text=redactor.redact(f'[‎ ]({url})' + text),
+                                                      disable_web_page_preview=True)
+            message_cache.add(answer_message)
+        except Exception:
+            logger.exception("Failed to post the summary of the bulk job %s", self.called_function)
+
+
+# The summary tasks of the detached jobs, referenced until they finish
+background_jobs = set()
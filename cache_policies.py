@@ -0,0 +1,9 @@
+# Seconds the results of the read-only functions are cached for, per chat and parameters
+function_cache_ttl = {
+    'getChatMemberCount': 60,
+}
+
+# Functions, which cached results in the chat are invalidated by a successful call of the write function
+function_invalidates = {
+    'banChatMembers': {'getChatMemberCount'},
+}
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from pyrogram.types import Message
+
+
+# Seconds the first trigger in a chat waits for more triggers to answer them together, 0 to handle every trigger alone
+COALESCE_WINDOW = 0
+# Max number of triggers answered together, the batch is submitted at once when it is full
+MAX_COALESCED_REQUESTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def batch_user_input(messages: list) -> str:
+    """
+    Builds one GPT user input from the coalesced trigger messages, so one answer addresses each of them.
+    :param messages: The trigger messages in the order they came. Data type: list of pyrogram.types.Message.
+    :return: The user input. Data type: str.
+    """
+    requests = "\n".join(
+        f"{index}. {message.from_user.first_name if message.from_user else 'Unknown'} "
+        f"(message {message.id}): {message.text}"
+        for index, message in enumerate(messages, start=1)
+    )
+    return ("Several requests were sent at the same time. Answer each of them in one message, "
+            "addressing every sender by name:\n" + requests)
+
+
+class RequestCoalescer:
+    """
+    Debounces the triggers per chat. The first trigger opens the window, the triggers coming within it are submitted
+    together as one batched request: submit(client, last_message, earlier_messages). With window 0 every trigger
+    is submitted alone right away.
+    """
+    def __init__(self, submit, window: float = COALESCE_WINDOW, max_batch: int = MAX_COALESCED_REQUESTS):
+        self.submit_request = submit
+        self.window = window
+        self.max_batch = max_batch
+        # {chat_id: (client, [message, ...])}
+        self.pending = {}
+        # {chat_id: window timer task}
+        self.timers = {}
+        self.batches = 0
+        self.coalesced = 0
+
+    async def submit(self, client, message: Message):
+        """
+        Adds the trigger to the batch of the chat. Registered as the pyrogram handler.
+        """
+        if not self.window:
+            return await self.submit_request(client, message)
+
+        chat_id = message.chat.id
+        _, chat_messages = self.pending.setdefault(chat_id, (client, []))
+        chat_messages.append(message)
+
+        if len(chat_messages) >= self.max_batch:
+            timer = self.timers.pop(chat_id, None)
+            if timer is not None:
+                timer.cancel()
+            await self.flush(chat_id)
+        elif len(chat_messages) == 1:
+            self.timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        self.timers.pop(chat_id, None)
+        try:
+            await self.flush(chat_id)
+        except Exception:
+            logger.exception("Failed to submit the coalesced requests in chat %s", chat_id)
+
+    async def flush(self, chat_id: int):
+        """
+        Submits the pending triggers of the chat: alone if there is one, otherwise as one batched request.
+        """
+        client, chat_messages = self.pending.pop(chat_id, (None, []))
+        if not chat_messages:
+            return
+        self.batches += 1
+        if len(chat_messages) == 1:
+            await self.submit_request(client, chat_messages[0])
+        else:
+            self.coalesced += len(chat_messages) - 1
+            await self.submit_request(client, chat_messages[-1], chat_messages[:-1])
+
+    def stats(self):
+        """
+        :return: The coalescer counters. Data type: dict.
+        """
+        return {
+            "batches": self.batches,
+            "coalesced": self.coalesced,
+            "chats_waiting": len(self.pending)
+        }
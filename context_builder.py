@@ -0,0 +1,180 @@
+import logging
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:
+    # Without tiktoken the tokens are estimated from the text length
+    tiktoken = None
+
+
+# Max number of prompt tokens of the context (without the answer) per model
+MODEL_CONTEXT_BUDGETS = {
+    "gpt-3.5-turbo": 3000,
+    "gpt-3.5-turbo-16k": 12000,
+    "gpt-4": 6000,
+    "gpt-4-turbo": 32000,
+    "gpt-4o": 32000,
+    "gpt-4o-mini": 32000,
+}
+DEFAULT_CONTEXT_BUDGET = 3000
+# Function results longer than this are truncated before anything else is dropped
+MAX_FUNCTION_RESULT_TOKENS = 500
+# Max number of cached token counts
+TOKEN_COUNT_CACHE_SIZE = 20000
+# Tokens added by the chat format to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+CHARS_PER_TOKEN = 4
+TRUNCATED_MARK = " ...(truncated)"
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """
+    Counts tokens of the context messages. Counts of the texts that never change (Telegram messages, function call
+    records) are cached by their key: the message id or the record URL.
+    """
+    def __init__(self, max_cached: int = TOKEN_COUNT_CACHE_SIZE):
+        self.max_cached = max_cached
+        self.counts = OrderedDict()
+        self._encodings = {}
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        if model not in self._encodings:
+            try:
+                self._encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encodings[model] = tiktoken.get_encoding("cl100k_base")
+        return self._encodings[model]
+
+    def count_text(self, text: str, model: str, key=None) -> int:
+        """
+        Counts the tokens of the text.
+        :param key: The cache key of the text, None not to cache the count.
+        """
+        if not text:
+            return 0
+        if key is not None and (key, model) in self.counts:
+            self.counts.move_to_end((key, model))
+            return self.counts[(key, model)]
+
+        encoding = self._encoding(model)
+        count = len(encoding.encode(text)) if encoding else len(text) // CHARS_PER_TOKEN + 1
+
+        if key is not None:
+            self.counts[(key, model)] = count
+            if len(self.counts) > self.max_cached:
+                self.counts.popitem(last=False)
+        return count
+
+    def count_message(self, context_message: dict, model: str, key=None) -> int:
+        """
+        Counts the tokens of the context message, including its tool calls.
+        """
+        text = context_message.get("content") or ""
+        for tool_call in context_message.get("tool_calls") or []:
+            text += tool_call["function"]["name"] + tool_call["function"]["arguments"]
+        return MESSAGE_OVERHEAD_TOKENS + self.count_text(text, model, key)
+
+    def truncate(self, text: str, max_tokens: int, model: str) -> str:
+        """
+        Cuts the text to max_tokens tokens, marking it as truncated.
+        """
+        encoding = self._encoding(model)
+        if encoding:
+            tokens = encoding.encode(text)
+            if len(tokens) <= max_tokens:
+                return text
+            return encoding.decode(tokens[:max_tokens]) + TRUNCATED_MARK
+
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        return text if len(text) <= max_chars else text[:max_chars] + TRUNCATED_MARK
+
+
+class ContextBuilder:
+    def __init__(self, counter: TokenCounter = None, budgets: dict = None, default_budget: int = DEFAULT_CONTEXT_BUDGET,
+                 max_function_result_tokens: int = MAX_FUNCTION_RESULT_TOKENS):
+        self.counter = counter or TokenCounter()
+        self.budgets = budgets or MODEL_CONTEXT_BUDGETS
+        self.default_budget = default_budget
+        self.max_function_result_tokens = max_function_result_tokens
+        self.tokens_saved_total = 0
+
+    def budget(self, model: str) -> int:
+        return self.budgets.get(model, self.default_budget)
+
+    def truncate_function_result(self, content: str, model: str) -> str:
+        """
+        Truncates the oversized function result before adding it to the context.
+        """
+        return self.counter.truncate(content, self.max_function_result_tokens, model)
+
+    @staticmethod
+    def group_turns(history: list, keys: list = None):
+        """
+        Groups the reply chain history into turns, so the tool calls are never separated from their responses:
+        every tool response belongs to the turn of the assistant message that called the tool.
+        :param keys: The token count cache keys of the history messages, None not to cache the counts.
+        :return: The turns, each is a list of (key, context message).
+        """
+        keys = keys or [None] * len(history)
+        turns = []
+        for key, context_message in zip(keys, history):
+            if context_message.get("role") == "tool" and turns:
+                turns[-1].append((key, context_message))
+            else:
+                turns.append([(key, context_message)])
+        return turns
+
+    def build(self, system_message: dict, history: list, user_message: dict, model: str, keys: list = None):
+        """
+        Builds the context within the token budget of the model. Oversized function results are truncated first,
+        then the oldest turns are dropped. The system message and the user input are always kept.
+        :param history: The reply chain history, oldest first.
+        :param keys: The token count cache keys of the history messages (message ids, record URLs),
+        None not to cache the counts.
+        :return: The context and the number of saved tokens. Data type: list, int.
+        """
+        budget = self.budget(model)
+        fixed_tokens = self.counter.count_message(system_message, model) + self.counter.count_message(user_message, model)
+
+        original_tokens = 0
+        turns_tokens = []
+        built_turns = []
+        for turn in self.group_turns(history, keys):
+            turn_tokens = 0
+            built_turn = []
+            for key, context_message in turn:
+                tokens = self.counter.count_message(context_message, model, key)
+                original_tokens += tokens
+                if (context_message.get("role") == "tool"
+                        and tokens - MESSAGE_OVERHEAD_TOKENS > self.max_function_result_tokens):
+                    context_message = {**context_message,
+                                       "content": self.truncate_function_result(context_message["content"], model)}
+                    tokens = self.counter.count_message(context_message, model)
+                turn_tokens += tokens
+                built_turn.append(context_message)
+            turns_tokens.append(turn_tokens)
+            built_turns.append(built_turn)
+
+        # Dropping the oldest turns until the context fits into the budget
+        total_tokens = fixed_tokens + sum(turns_tokens)
+        first_kept = 0
+        while total_tokens > budget and first_kept < len(built_turns):
+            total_tokens -= turns_tokens[first_kept]
+            first_kept += 1
+
+        context = [system_message, *(context_message for turn in built_turns[first_kept:] for context_message in turn),
+                   user_message]
+        tokens_saved = fixed_tokens + original_tokens - total_tokens
+        self.tokens_saved_total += tokens_saved
+        if tokens_saved:
+            logger.info("Context built for %s: %s tokens, %s tokens saved, %s of %s turns dropped",
+                        model, total_tokens, tokens_saved, first_kept, len(built_turns))
+        return context, tokens_saved
+
+
+context_builder = ContextBuilder()
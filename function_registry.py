@@ -0,0 +1,186 @@
+import json
+from pyrogram.enums import ChatMemberStatus
+from list_gpt_functions import gpt3_functions
+from secure_parameters import SecureParameters, function_required_spm
+from permissions import permissions
+from cache_policies import function_cache_ttl, function_invalidates
+from bulk_moderation import bulk_requests
+
+
+JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+
+
+def compile_validator(schema: dict, path: str = "arguments"):
+    """
+    Compiles the JSON schema of the function parameters into a validator. Supports the schema keywords used in
+    list_gpt_functions.py: type, properties, required, items, enum, minLength/maxLength, minimum/maximum, minItems/maxItems.
+    :return: validator(value) -> error_msg. Empty error_msg if the value is valid.
+    """
+    checks = []
+    expected_type = schema.get("type")
+
+    if expected_type in JSON_TYPES:
+        python_type = JSON_TYPES[expected_type]
+        # bool is a subclass of int, but not a valid integer or number
+        def check_type(value):
+            if not isinstance(value, python_type) or (isinstance(value, bool) and expected_type != "boolean"):
+                return f"{path} must be {expected_type}. "
+            return ''
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+        checks.append(lambda value: '' if value in allowed else f"{path} must be one of {allowed}. ")
+
+    for keyword, compare, message in (
+        ("minLength", lambda value, limit: len(value) >= limit, "must be at least {} characters long"),
+        ("maxLength", lambda value, limit: len(value) <= limit, "must be at most {} characters long"),
+        ("minItems", lambda value, limit: len(value) >= limit, "must have at least {} items"),
+        ("maxItems", lambda value, limit: len(value) <= limit, "must have at most {} items"),
+        ("minimum", lambda value, limit: value >= limit, "must be at least {}"),
+        ("maximum", lambda value, limit: value <= limit, "must be at most {}"),
+    ):
+        if keyword in schema:
+            limit = schema[keyword]
+            checks.append(lambda value, compare=compare, limit=limit, message=message:
+                          '' if compare(value, limit) else f"{path} {message.format(limit)}. ")
+
+    if expected_type == "object":
+        property_validators = {name: compile_validator(property_schema, f"{path}.{name}")
+                               for name, property_schema in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+
+        def check_properties(value):
+            error_msg = ''.join(f"{path}.{name} is required. " for name in required if name not in value)
+            for name, validator in property_validators.items():
+                if name in value:
+                    error_msg += validator(value[name])
+            return error_msg
+        checks.append(check_properties)
+
+    if expected_type == "array" and "items" in schema:
+        item_validator = compile_validator(schema["items"], f"{path}[]")
+        checks.append(lambda value: ''.join(item_validator(item) for item in value))
+
+    def validator(value):
+        for check in checks:
+            error_msg = check(value)
+            # Type errors make the other checks meaningless
+            if error_msg:
+                return error_msg
+        return ''
+    return validator
+
+
+class RegisteredFunction:
+    def __init__(self, schema: dict, secure_parameters: list, roles: set, executor: str, cache_ttl: float = None,
+                 invalidates: set = None):
+        self.name = schema["name"]
+        self.schema = schema
+        self.secure_parameters = secure_parameters
+        self.roles = roles
+        # Name of the FunctionCall method executing the function
+        self.executor = executor
+        # Seconds the result is cached for, None if the function is not read-only
+        self.cache_ttl = cache_ttl
+        # Functions, which cached results are invalidated by a successful call
+        self.invalidates = invalidates or set()
+        self.properties = set(schema["parameters"].get("properties", {}))
+        self.validator = compile_validator(schema["parameters"])
+
+    def allows(self, user_status: ChatMemberStatus) -> bool:
+        return user_status in self.roles
+
+    def secure_params(self, message) -> dict:
+        """
+        :return: The secure parameters of the function call (chat_id, etc.), taken from the request message.
+        """
+        return SecureParameters(self.secure_parameters, message).get_all()
+
+    def parse_arguments(self, arguments: str):
+        """
+        Parses and validates the arguments of the function call, generated by GPT.
+        The parameters, which are not in the schema, are dropped: the secure parameters can't be passed by GPT.
+        :return: params, error_msg. In case of an error, 'params' will be a string, otherwise a dict.
+        """
+        try:
+            params = json.loads(arguments) if arguments else {}
+        except (json.JSONDecodeError, TypeError):
+            return str(arguments), "Invalid JSON format in arguments. "
+
+        error_msg = self.validator(params)
+        if error_msg:
+            return str(arguments), error_msg
+        return {name: value for name, value in params.items() if name in self.properties}, ''
+
+
+class FunctionRegistry:
+    """
+    All the metadata of the GPT functions in one place: schema, arguments validator, secure parameters, allowed roles,
+    executor and result caching policy. Built once at startup, the per-role functions lists are precomputed.
+    """
+    def __init__(self, functions: list):
+        self.functions = {function.name: function for function in functions}
+        self.role_functions = {
+            status: [function.schema for function in functions if function.allows(status)]
+            for status in ChatMemberStatus
+        }
+
+    def get(self, name: str) -> RegisteredFunction:
+        """
+        :return: The registered function or None if it doesn't exist.
+        """
+        return self.functions.get(name)
+
+    def functions_for(self, user_status: ChatMemberStatus) -> list:
+        """
+        :return: The schemas of the functions the user with user_status can call, to be passed to GPT.
+        """
+        return self.role_functions.get(user_status, [])
+
+    def functions_for_all(self, user_statuses: list) -> list:
+        """
+        :return: The schemas of the functions all the users can call. Used for the coalesced requests,
+        so no user gets a function through the status of another one.
+        """
+        user_statuses = set(user_statuses)
+        if len(user_statuses) == 1:
+            return self.functions_for(user_statuses.pop())
+        return [function.schema for function in self.functions.values()
+                if all(function.allows(user_status) for user_status in user_statuses)]
+
+    @classmethod
+    def build(cls):
+        """
+        Builds the registry from list_gpt_functions.py, secure_parameters.py, permissions.py, cache_policies.py
+        and bulk_moderation.py. The bulk functions are executed as bulk jobs, the others as one Telegram API request.
+        """
+        functions = []
+        for schema in gpt3_functions:
+            name = schema["name"]
+            functions.append(RegisteredFunction(
+                schema,
+                secure_parameters=function_required_spm.get(name, []),
+                roles={status for status, allowed_functions in permissions.items() if name in allowed_functions},
+                executor="bulk_telegram_api_execution" if name in bulk_requests else "telegram_api_execution",
+                cache_ttl=function_cache_ttl.get(name),
+                invalidates=function_invalidates.get(name)
+            ))
+
+        # An invalidation of a function, which results are never cached, would silently do nothing
+        cached_functions = {function.name for function in functions if function.cache_ttl}
+        for function in functions:
+            if function.invalidates - cached_functions:
+                raise ValueError(f"FunctionRegistry: {function.name} invalidates functions, which are not registered "
+                                 f"or not cached: {sorted(function.invalidates - cached_functions)}")
+        return cls(functions)
+
+
+function_registry = FunctionRegistry.build()
@@ -1,9 +1,75 @@
 from pyrogram.types import Message
-from secure_parameters import SecureParameters
 import aiohttp
+import asyncio
 import json
+import time
+from collections import OrderedDict, defaultdict
 from config import TELEGRAM_TOKEN
-from list_gpt_functions import gpt3_functions_set
+from initialize_app import http_client
+from function_registry import function_registry
+from bulk_moderation import BulkJob, is_detached
+from resilience import attempt_timeout
+
+
+# Telegram Bot API base URL
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Max number of cached function results
+FUNCTION_RESULT_CACHE_SIZE = 10000
+
+
+class FunctionResultCache:
+    """
+    Cache of the read-only function results, keyed by the function, chat and normalized parameters.
+    Each entry lives for the cache_ttl of its registered function (see cache_policies.py).
+    """
+    def __init__(self, max_size: int = FUNCTION_RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        # {(called_function, chat_id, params_json): (result, expiration time)}
+        self.results = OrderedDict()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    @staticmethod
+    def key(called_function: str, chat_id: int, params: dict):
+        return called_function, chat_id, json.dumps(params, sort_keys=True, default=str)
+
+    def get(self, key: tuple):
+        """
+        :return: The cached result or None in case of a miss.
+        """
+        result, expires = self.results.get(key, (None, 0))
+        if result is None or expires < time.monotonic():
+            self.misses[key[0]] += 1
+            return None
+        self.hits[key[0]] += 1
+        self.results.move_to_end(key)
+        return result
+
+    def set(self, key: tuple, result, ttl: float):
+        self.results[key] = (result, time.monotonic() + ttl)
+        self.results.move_to_end(key)
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def invalidate(self, chat_id: int, functions: set):
+        """
+        Drops the cached results of the functions in the chat.
+        """
+        for key in [key for key in self.results if key[1] == chat_id and key[0] in functions]:
+            del self.results[key]
+
+    def stats(self):
+        """
+        :return: The hits, misses and hit rate per function. Data type: dict.
+        """
+        return {
+            called_function: {
+                "hits": self.hits[called_function],
+                "misses": self.misses[called_function],
+                "hit_rate": self.hits[called_function] / (self.hits[called_function] + self.misses[called_function])
+            }
+            for called_function in set(self.hits) | set(self.misses)
+        }
 
 
 
@@ -17,16 +83,36 @@ class FunctionCall:
 
     async def execute(self) -> tuple:
         """
-        Executes the function call. Returns the result and error.
+        Executes the function call with the executor of the registered function. Returns the result and error.
         Each method requires its own values to be provided while initializing the FunctionCall class.
         Not to get raised error pass all the required values.
+        The results of the read-only functions are cached, a successful write function call invalidates
+        the related cached results in the chat. A detached bulk job invalidates them when it finishes.
         :return: The result and error. Data type: dict, str.
         """
 
-        for method in function_call_methods.keys():
-            if self.called_function in function_call_methods[method]:
-                self.result, self.error = await method(self)
-                break
+        function = function_registry.get(self.called_function)
+        if not function:
+            return self.result, self.error
+        method = getattr(self, function.executor)
+
+        chat_id = self.message.chat.id if self.message else None
+        ttl = function.cache_ttl
+        if ttl:
+            # The key is made before executing, because the secure parameters are added to the params
+            cache_key = FunctionResultCache.key(self.called_function, chat_id, self.params)
+            cached_result = result_cache.get(cache_key)
+            if cached_result is not None:
+                self.result = cached_result
+                return self.result, self.error
+
+        self.result, self.error = await method()
+
+        if not self.error:
+            if ttl:
+                result_cache.set(cache_key, self.result, ttl)
+            if function.invalidates and not is_detached(self.result):
+                result_cache.invalidate(chat_id, function.invalidates)
         return self.result, self.error
 
     async def telegram_api_execution(self):
@@ -45,27 +131,49 @@ class FunctionCall:
         try:
             
             # Telegram API URL
-            telegram_api_url = f'https://api.telegram.org/bot{TELEGRAM_TOKEN}/{self.called_function}'
+            telegram_api_url = f'{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/{self.called_function}'
             # Get the secure parameters (chat_id, etc.)
-            secure_params = SecureParameters(self.called_function, self.message).get_all()
+            secure_params = function_registry.get(self.called_function).secure_params(self.message)
             self.params.update(secure_params)
             
-            async with aiohttp.ClientSession() as session:
-                try:
-                    # Send the request to the Telegram API
-                    async with session.post(telegram_api_url, json=self.params) as resp:
-                        resp.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
-                        self.result = await resp.json()
-                except aiohttp.ClientResponseError as e:
-                    self.error += f"HTTP error occurred: {e.status}. "
-                except json.JSONDecodeError as e:
-                    self.error += f"JSON decode error occurred: {e}. "
+            try:
+                # Send the request to the Telegram API, within the request deadline
+                async with http_client.session.post(telegram_api_url, json=self.params,
+                                                    timeout=aiohttp.ClientTimeout(total=attempt_timeout())) as resp:
+                    resp.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
+                    self.result = await resp.json()
+            except aiohttp.ClientResponseError as e:
+                self.error += f"HTTP error occurred: {e.status}. "
+            except json.JSONDecodeError as e:
+                self.error += f"JSON decode error occurred: {e}. "
+            except asyncio.TimeoutError:
+                self.error += "The request deadline has passed before the Telegram API answered. "
         
         except Exception as e:
             self.error += str(e) + ' '
 
         return self.result, self.error
+
+    async def bulk_telegram_api_execution(self):
+        """
+        Executes the bulk function call as one job of many Telegram API requests (see bulk_moderation.py).
+        :return: The summary result or error. Data type: dict, str.
+        """
+        try:
+            function = function_registry.get(self.called_function)
+            chat_id = self.message.chat.id if self.message else None
+            secure_params = function.secure_params(self.message)
+            job = BulkJob(self.called_function, self.params, secure_params, f'{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}',
+                          self.message, on_finish=lambda: result_cache.invalidate(chat_id, function.invalidates))
+            self.error += job.validate()
+            if not self.error:
+                self.result = await job.run_or_detach()
+                self.params.update(secure_params)
+        except Exception as e:
+            self.error += str(e) + ' '
+
+        return self.result, self.error
     
 
 
-function_call_methods = {FunctionCall.telegram_api_execution: gpt3_functions_set}
\ No newline at end of file
+result_cache = FunctionResultCache()
@@ -1,13 +1,24 @@
-from typing import List
+from typing import Callable, List
+import asyncio
 from collections import deque
-import ast
+import json
+import re
 from pyrogram.enums import MessageEntityType
 from pyrogram.types import Message
-from telegraph import TelegraphPage
+from record_store import records
+from context_builder import context_builder
+from rate_limits import openai_limiter
+from metrics import metrics
+from resilience import openai_caller
 import openai
 from config import GPT_SYS_MESSAGE
 from initialize_app import app
-from list_gpt_functions import gpt3_functions_set
+from message_cache import message_cache
+from function_registry import function_registry
+
+
+# {(chat_id, reply_to_message_id): future of the replies context history reconstruction in progress}
+replies_history_futures = {}
 
 
 class GPT:
@@ -16,13 +27,16 @@ class GPT:
         self.message = message
         self.user_input = user_input
         self.replies_context_history = replies_context_history or []
+        # Token count cache keys of the replies context history messages (message ids, record URLs)
+        self.replies_context_keys = []
         self.context = context or []
         self.model = model
+        self.tokens_saved = 0
 
 
     async def acreate(self, functions: list, context: list, function_call: str = "auto",  model: str = "gpt-3.5-turbo") -> dict:
         """
-        Creates a GPT chat response. 
+        Creates a GPT chat response. The functions are passed as tools, so GPT can call several of them in one response.
         :param functions: The list of functions to use in the GPT interaction.
         :param context: The context for the GPT interaction. The last message in the context is the user input.
         :param function_call: The function call type. Can be 'auto', 'none'.
@@ -32,20 +46,120 @@ class GPT:
 
         self.model = model or self.model
         self.context = context or self.context
-        
-        openai_response = await openai.ChatCompletion.acreate(
-            model=self.model,
-            messages=self.context,
-            functions=functions,
-            function_call=function_call
-        )
 
-        return openai_response
+        async def attempt(attempt_model: str, acquired_tokens: int) -> dict:
+            with metrics.span("openai", model=attempt_model):
+                openai_response = await openai.ChatCompletion.acreate(
+                    model=attempt_model,
+                    messages=self.context,
+                    **self.tools_kwargs(functions, function_call)
+                )
+
+            if openai_response.get('usage'):
+                openai_limiter.used(acquired_tokens, openai_response['usage']['total_tokens'])
+                metrics.record_usage(self.chat_id, attempt_model, openai_response['usage'])
+            return openai_response
+
+        # Retried, hedged and falling back to the secondary model as configured in resilience.py
+        return await openai_caller.call(attempt, self.model, acquire=self.acquire_budget)
+
+    async def acreate_stream(self, functions: list, context: list, on_content: Callable[[str], None],
+                             function_call: str = "auto", model: str = "gpt-3.5-turbo") -> dict:
+        """
+        Creates a GPT chat response, consuming it as a stream. The content is passed to on_content as soon as it arrives,
+        the tool calls are collected from the stream.
+        :param on_content: Called with the whole content received so far, every time a new part of it arrives.
+        :return: openai_response (dict) in the same format as from acreate().
+        """
+        self.model = model or self.model
+        self.context = context or self.context
+
+        async def attempt(attempt_model: str, acquired_tokens: int) -> dict:
+            with metrics.span("openai", model=attempt_model, stream=True):
+                # A stalled stream is detected by the timeout to the first chunk and between the chunks
+                stream = await asyncio.wait_for(openai.ChatCompletion.acreate(
+                    model=attempt_model,
+                    messages=self.context,
+                    stream=True,
+                    # The usage comes in the last chunk
+                    stream_options={"include_usage": True},
+                    **self.tools_kwargs(functions, function_call)
+                ), openai_caller.timeout())
+                chunks = stream.__aiter__()
+
+                content, finish_reason, usage = '', None, None
+                # {index: tool call}, the tool call ids, names and arguments come in parts
+                tool_calls = {}
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), openai_caller.timeout())
+                    except StopAsyncIteration:
+                        break
+                    usage = chunk.get('usage') or usage
+                    if not chunk['choices']:
+                        continue
+                    choice = chunk['choices'][0]
+                    delta = choice.get('delta', {})
+                    finish_reason = choice.get('finish_reason') or finish_reason
+
+                    if delta.get('content'):
+                        content += delta['content']
+                        on_content(content)
+
+                    for tool_call_delta in delta.get('tool_calls') or []:
+                        tool_call = tool_calls.setdefault(tool_call_delta['index'], {
+                            "id": '', "type": "function", "function": {"name": '', "arguments": ''}})
+                        tool_call["id"] += tool_call_delta.get('id') or ''
+                        function_delta = tool_call_delta.get('function') or {}
+                        tool_call["function"]["name"] += function_delta.get('name') or ''
+                        tool_call["function"]["arguments"] += function_delta.get('arguments') or ''
+
+            if usage:
+                openai_limiter.used(acquired_tokens, usage['total_tokens'])
+                metrics.record_usage(self.chat_id, attempt_model, usage)
+
+            message = {"role": "assistant", "content": content or None}
+            if tool_calls:
+                message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+            return {"choices": [{"index": 0, "finish_reason": finish_reason, "message": message}], "usage": usage}
+
+        # A retried stream starts the content over
+        return await openai_caller.call(attempt, self.model, stream=True, acquire=self.acquire_budget)
+
+    @property
+    def chat_id(self):
+        return self.message.chat.id if self.message else None
+
+    async def acquire_budget(self) -> int:
+        """
+        Waits for the rate limit budget of one OpenAI request with the current context.
+        :return: The number of acquired tokens.
+        """
+        return await openai_limiter.acquire(self.count_context_tokens())
+
+    def count_context_tokens(self) -> int:
+        """
+        :return: The number of prompt tokens of the context, used to budget the OpenAI request.
+        """
+        return sum(context_builder.counter.count_message(context_message, self.model) for context_message in self.context)
+
+    @staticmethod
+    def tools_kwargs(functions: list, function_call: str = "auto") -> dict:
+        """
+        :return: The tools kwargs for the OpenAI request. OpenAI rejects an empty tools list,
+        so the tools are passed only if there are any.
+        """
+        if not functions:
+            return {}
+        return {
+            "tools": [{"type": "function", "function": function} for function in functions],
+            "tool_choice": function_call
+        }
 
     
     async def get_context(self, get_replies=False, message: Message=None):
         """
-        Gets the context for the GPT interaction.
+        Gets the context for the GPT interaction, limited to the token budget of the model.
         :param get_replies: If True, gets the context from the message reply history.
         :param message: The message to get the context from.
         :return: The context in format [{'role': 'user', 'content': 'message text'}, ...]
@@ -59,11 +173,14 @@ class GPT:
             get_replies=False
         
         if get_replies:
-            self.context = [
+            # Fitting the context into the token budget of the model, dropping the oldest replies first
+            self.context, self.tokens_saved = context_builder.build(
                 {"role": "system", "content": GPT_SYS_MESSAGE},
-                *await self.get_replies_context_history(self.message),
-                {"role": "user", "content": self.user_input}
-            ]  
+                await self.get_replies_context_history(self.message),
+                {"role": "user", "content": self.user_input},
+                self.model,
+                keys=self.replies_context_keys
+            )
         else:
             self.context = [{"role": "user", "content": self.user_input}]
         return self.context
@@ -84,78 +201,159 @@ class GPT:
             return self.replies_context_history
         
         self.message = message or self.message
-        if not self.message:
+        if not self.message or not self.message.reply_to_message_id:
             return []
-        
+
+        # Requests replying to the same message have the same reply chain, the concurrent ones await one reconstruction
+        key = (self.message.chat.id, self.message.reply_to_message_id)
+        future = replies_history_futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.build_replies_context_history(self.message))
+            replies_history_futures[key] = future
+            future.add_done_callback(lambda _: replies_history_futures.pop(key, None))
+        # Shielded, so a cancelled request doesn't cancel the reconstruction awaited by the others
+        history, keys = await asyncio.shield(future)
+
+        self.replies_context_history = list(history)
+        self.replies_context_keys = list(keys)
+        return self.replies_context_history
+
+    async def build_replies_context_history(self, message: Message):
+        """
+        Reconstructs the context history from the reply chain of the message and the function call records.
+        :return: (context history, token count cache keys of its messages). Data type: tuple of lists.
+        """
+        # Collecting the reply chain first, so the Telegraph pages of all the messages can be read at once
+        chain_messages = []
+        current_message = message
+
+        with metrics.span("reply_chain_fetch"):
+            while current_message.reply_to_message_id:
+                # Get the message that the current message is replying to
+                current_message = await self.get_replied_message(current_message)
+                if not current_message or current_message.empty:
+                    break
+                chain_messages.append(current_message)
+
+        # Get the record URLs from the messages, where the function call and response or error are stored
+        messages_record_urls = [self.extract_message_telegraph_urls(chain_message) for chain_message in chain_messages]
+        with metrics.span("record_reads"):
+            function_call_records = await records.read_many(
+                [url for record_urls in messages_record_urls for url in record_urls])
+
         # Using deque() to add the messages to the context history in the order, that they were sent
         replies_context_deque = deque()
-        current_message = self.message
+        replies_context_keys = deque()
+
+        for chain_message, record_urls in zip(chain_messages, messages_record_urls):
+            # Add the message text that the current message is replying to to the context history
+            sender_role = "assistant" if chain_message.from_user.is_self else "user"
+            replies_context_deque.appendleft({"role": sender_role, "content": chain_message.text})
+            replies_context_keys.appendleft((chain_message.chat.id, chain_message.id))
 
-        while current_message.reply_to_message_id:
-            # Get the message that the current message is replying to
-            current_message = await app.get_messages(current_message.chat.id, current_message.reply_to_message_id)
+            # Add the function calls and responses or errors from the records to the context history,
+            # as one assistant message with all the tool calls followed by the tool responses
+            tool_calls, tool_responses, found_urls = [], [], []
+            for url in record_urls:
+                if url not in function_call_records:
+                    continue
+                found_urls.append(url)
+                called_function, params, result = function_call_records[url]
+                tool_call_id = self.record_tool_call_id(url)
+                arguments = json.dumps(params) if isinstance(params, dict) else str(params)
+                tool_calls.append({"id": tool_call_id, "type": "function", "function": {"name": called_function, "arguments": arguments}})
+                tool_responses.append({"role": "tool", "tool_call_id": tool_call_id, "content": str(result)})
+            if tool_calls:
+                replies_context_deque.extendleft(reversed([{"role": "assistant", "content": None, "tool_calls": tool_calls}, *tool_responses]))
+                replies_context_keys.extendleft(reversed([tuple(found_urls), *found_urls]))
 
-            # Get the telegraph URLs from the message, where the function call and response or error are posted
-            telegraph_urls = self.extract_message_telegraph_urls(current_message)
+        return list(replies_context_deque), list(replies_context_keys)
 
-            # Add the message text that the current message is replying to to the context history
-            sender_role = "assistant" if current_message.from_user.is_self else "user"
-            replies_context_deque.appendleft({"role": sender_role, "content": current_message.text})
+    @staticmethod
+    async def get_replied_message(message: Message):
+        """
+        Gets the message that the message is replying to. Resolves it from the message itself or from the message cache,
+        only in case of a miss requests Telegram for this one message. The reply chain is walked hop by hop,
+        so the cache is checked at each hop before anything is fetched.
+        :param message: The pyrogram message object.
+        :return: The replied pyrogram message object.
+        """
+        if message.reply_to_message:
+            return message.reply_to_message
 
-            # Add the function call and response or error from the telegraph URLs to the context history
-            for url in reversed(telegraph_urls):
-                called_function, params, result = await TelegraphPage(url=url).read_telegraph_page()
-                replies_context_deque.appendleft({"role": "function", "name": called_function, "content": str(result)})
-                replies_context_deque.appendleft({"role": "assistant", "content": None,"function_call": {"name": called_function,"arguments": str(params)}})
+        replied_message = message_cache.get(message.chat.id, message.reply_to_message_id)
+        if replied_message:
+            return replied_message
 
-        self.replies_context_history = list(replies_context_deque)
-        return self.replies_context_history
+        # replies=0: pyrogram would fetch each further level of the chain with its own request, also the cached ones
+        replied_message = await app.get_messages(message.chat.id, message.reply_to_message_id, replies=0)
+        message_cache.add(replied_message)
+        return replied_message
+
+    @staticmethod
+    def record_tool_call_id(url: str):
+        """
+        :return: The tool call id for the restored function call record, unique per record.
+        """
+        return "call_" + re.sub(r'\W', '_', url.split('/')[-1])
 
     def extract_message_telegraph_urls(self, message: Message=None, only_bot_messages: bool=True):
         """
-        Extracts the telegraph URLs from the message.
-        :param message: The message to extract the telegraph URLs from.
-        :param only_bot_messages: If True, only extracts the telegraph URLs from the bot messages.
-        :return: The telegraph URLs in format ['https://telegra.ph/...', ...]
+        Extracts the function call record URLs (Telegraph pages or local records) from the message.
+        :param message: The message to extract the record URLs from.
+        :param only_bot_messages: If True, only extracts the record URLs from the bot messages.
+        :return: The record URLs in format ['https://telegra.ph/...', 'https://telegram.me/GPTModerBot?record=...', ...]
         """
-        if not (only_bot_messages and message.from_user.is_self):
+        message = message or self.message
+        if not message:
             return []
-        
-        self.message = message or self.message
-        if not self.message:
+
+        if only_bot_messages and not message.from_user.is_self:
             return []
         
-        telegraph_urls = []
-        if self.message.entities:
-            for entity in self.message.entities:
-                if entity.type == MessageEntityType.TEXT_LINK and entity.url.startswith('https://telegra.ph'):
-                    telegraph_urls.append(entity.url)
-        return telegraph_urls
+        record_urls = []
+        if message.entities:
+            for entity in message.entities:
+                if entity.type == MessageEntityType.TEXT_LINK and records.is_record_url(entity.url):
+                    record_urls.append(entity.url)
+        return record_urls
     
     @staticmethod
-    async def handle_function_call(openai_response: dict):
+    def handle_function_call(tool_call: dict):
         """
-        Handles the function call and arguments from GPT response. In case of an error, 'params' will be a string, otherwise a dict.
-        :param openai_response: The response from GPT-3. Data type: dict.
-        :return: is_function_call, called_function, params, error_msg. Data type: bool, str, dict/str, str.
+        Handles the function call and arguments of one tool call from GPT response. In case of an error, 'params' will be a string, otherwise a dict.
+        :param tool_call: The tool call from GPT response. Data type: dict.
+        :return: called_function, params, error_msg. Data type: str, dict/str, str.
         """
         called_function, params, error_msg = None, None, ''
 
         try:
-            # Check if the response contains a function call
-            if openai_response['choices'][0]['finish_reason'] == 'function_call':
-                
-                called_function = openai_response['choices'][0]['message']['function_call']['name']
-                # Check if the called function exists
-
-                if called_function not in gpt3_functions_set:
-                    error_msg += f"Called function {called_function} doesn't exist. "
-                try:
-                    # Get the arguments of the function call, generated by GPT
-                    params = ast.literal_eval(openai_response['choices'][0]['message']['function_call']['arguments'])
-                except Exception as e:
-                    error_msg += f"Invalid JSON format in arguments. "
-                    params = str(openai_response['choices'][0]['message']['function_call']['arguments'])
+            called_function = tool_call['function']['name']
+            arguments = tool_call['function']['arguments']
+            # Check if the called function exists
+            function = function_registry.get(called_function)
+            if not function:
+                error_msg += f"Called function {called_function} doesn't exist. "
+                params = str(arguments)
+            else:
+                # Parse and validate the arguments of the function call, generated by GPT
+                params, error_msg = function.parse_arguments(arguments)
         except Exception as e:
             error_msg += str(e) + ' '
         return called_function, params, error_msg
+
+    @staticmethod
+    async def handle_tool_calls(openai_response: dict):
+        """
+        Handles all the tool calls from GPT response, in the order GPT returned them.
+        :param openai_response: The response from GPT-3. Data type: dict.
+        :return: [(tool_call_id, called_function, params, error_msg), ...]. Empty if GPT didn't call any function.
+        """
+        try:
+            if openai_response['choices'][0]['finish_reason'] != 'tool_calls':
+                return []
+            tool_calls = openai_response['choices'][0]['message']['tool_calls']
+        except Exception:
+            return []
+
+        return [(tool_call['id'], *GPT.handle_function_call(tool_call)) for tool_call in tool_calls]
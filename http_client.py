@@ -0,0 +1,49 @@
+import aiohttp
+
+
+# Max number of open connections in total and per host
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_CONNECTIONS_PER_HOST = 20
+# Seconds to cache resolved DNS names and to keep idle connections alive
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 60
+# Seconds for the whole request and for establishing the connection
+HTTP_TOTAL_TIMEOUT = 60
+HTTP_CONNECT_TIMEOUT = 10
+
+
+class HTTPClient:
+    """
+    Application-scoped pooled HTTP session, shared by the Telegram Bot API, Telegraph and OpenAI calls.
+    Started and closed together with the pyrogram app (see main.py).
+    """
+    def __init__(self, max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_connections_per_host: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+                 dns_cache_ttl: int = HTTP_DNS_CACHE_TTL, keepalive_timeout: int = HTTP_KEEPALIVE_TIMEOUT,
+                 total_timeout: float = HTTP_TOTAL_TIMEOUT, connect_timeout: float = HTTP_CONNECT_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The shared session. Created on first use, so it is always bound to the running event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
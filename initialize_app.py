@@ -1,16 +1,26 @@
+import os
 from pyrogram import Client
 from pyrogram.enums import ParseMode
 from config import TELEGRAM_TOKEN, API_ID, API_HASH
+from http_client import HTTPClient
 
+# Set by the worker pool (see workers.py) for the worker processes
+WORKER_ENV = "GPTMODER_WORKER"
 
-def initialize_app():
-    # Pyrogram Client
+
+def initialize_app(worker: str = None):
+    # Pyrogram Client. The worker processes use their own in-memory sessions without updates,
+    # the updates are received only by the intake process
     return Client(
-        "my_bot",
+        f"my_bot_worker_{worker}" if worker else "my_bot",
         api_id=API_ID,
         api_hash=API_HASH,
         bot_token=TELEGRAM_TOKEN,
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.MARKDOWN,
+        in_memory=bool(worker),
+        no_updates=bool(worker)
     ) 
 
-app = initialize_app()
\ No newline at end of file
+app = initialize_app(os.environ.get(WORKER_ENV))
+# Pooled HTTP session for all the outbound HTTP calls, lives as long as the app
+http_client = HTTPClient()
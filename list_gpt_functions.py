@@ -22,6 +22,80 @@ gpt3_functions = [
             },
             "required": ["description"]
         }
+    },
+    {
+        "name": "banChatMembers",
+        "description": "Ban many users in the chat at once, e.g. a spam wave. Runs as one job",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "user_ids": {
+                    "type": "array",
+                    "description": "Unique identifiers of the users to ban",
+                    "items": {"type": "integer"},
+                    "minItems": 1,
+                    "maxItems": 1000
+                },
+                "revoke_messages": {
+                    "type": "boolean",
+                    "description": "Delete all the messages of the users in the chat"
+                }
+            },
+            "required": ["user_ids"]
+        }
+    },
+    {
+        "name": "restrictChatMembers",
+        "description": "Restrict many users in the chat at once, e.g. mute them. Runs as one job",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "user_ids": {
+                    "type": "array",
+                    "description": "Unique identifiers of the users to restrict",
+                    "items": {"type": "integer"},
+                    "minItems": 1,
+                    "maxItems": 1000
+                },
+                "permissions": {
+                    "type": "object",
+                    "description": "New permissions of the users, the omitted ones are not allowed",
+                    "properties": {
+                        "can_send_messages": {"type": "boolean"},
+                        "can_send_photos": {"type": "boolean"},
+                        "can_send_videos": {"type": "boolean"},
+                        "can_send_documents": {"type": "boolean"},
+                        "can_send_other_messages": {"type": "boolean"},
+                        "can_add_web_page_previews": {"type": "boolean"}
+                    }
+                },
+                "until_date": {
+                    "type": "integer",
+                    "description": "Unix time when the restrictions are lifted, forever if omitted"
+                }
+            },
+            "required": ["user_ids", "permissions"]
+        }
+    },
+    {
+        "name": "deleteMessagesRange",
+        "description": "Delete all the messages with ids from from_message_id to to_message_id in the chat. Runs as one job",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "from_message_id": {
+                    "type": "integer",
+                    "description": "Identifier of the first message to delete",
+                    "minimum": 1
+                },
+                "to_message_id": {
+                    "type": "integer",
+                    "description": "Identifier of the last message to delete, at most 1000 messages after the first one",
+                    "minimum": 1
+                }
+            },
+            "required": ["from_message_id", "to_message_id"]
+        }
     }
 ]
 
@@ -1,22 +1,91 @@
-from initialize_app import app
+from initialize_app import app, http_client
 from message_handler import handle_message
-from pyrogram.handlers import MessageHandler
-from pyrogram import filters
+from message_cache import cache_message, message_cache, sent_messages
+from member_cache import member_cache, update_chat_member
+from scheduler import RequestScheduler
+from coalescer import RequestCoalescer
+from workers import WorkerPool, WORKER_PROCESSES
+from metrics import metrics
+from telegraph import telegraph_cache
+from functioncall import result_cache
+from context_builder import context_builder
+from pyrogram.handlers import ChatMemberUpdatedHandler, MessageHandler
+from pyrogram import filters, idle
+from redaction import redactor, RedactingFilter
+from resilience import openai_caller
+import logging
+import openai
 
 
 def bot_request_flter(data):
     async def func(flt, _, message):
-        replied_is_self = False
-        if message.reply_to_message_id:
-            replied_msg = await app.get_messages(message.chat.id, message.reply_to_message_id)
-            replied_is_self = replied_msg.from_user.is_self
-        return flt.data in message.text or replied_is_self
+        with metrics.span("trigger_filter"):
+            # Media messages without text can't be handled
+            if message.text is None:
+                return False
+            if flt.data in message.text:
+                return True
+            if not message.reply_to_message_id:
+                return False
+
+            # Deciding without requests to Telegram: pyrogram has already fetched the replied message with the update,
+            # it is missing only if it was deleted, then the bot's sent messages index is checked
+            if message.reply_to_message:
+                return bool(message.reply_to_message.from_user and message.reply_to_message.from_user.is_self)
+            return sent_messages.contains(message.chat.id, message.reply_to_message_id)
 
     # "data" kwarg is accessed with "flt.data" above
     return filters.create(func, data=data)
 
-# Register the Message Handler
-app.add_handler(MessageHandler(handle_message, bot_request_flter("gptm")))
+# Register the Message Handlers. Group -1 runs first, so every message is cached before the request is handled
+app.add_handler(MessageHandler(cache_message), group=-1)
+# The requests are handled through the scheduler, which limits the concurrency per chat and in total.
+# With WORKER_PROCESSES they are queued to the worker processes, each running its own scheduler.
+# With COALESCE_WINDOW the triggers coming in a burst in one chat are submitted as one request
+scheduler = RequestScheduler(handle_message)
+worker_pool = WorkerPool(WORKER_PROCESSES)
+coalescer = RequestCoalescer(worker_pool.submit if WORKER_PROCESSES else scheduler.submit)
+app.add_handler(MessageHandler(coalescer.submit, bot_request_flter("gptm")))
+# Chat member status changes keep the member status cache up to date. With WORKER_PROCESSES the caches are
+# in the workers, the changes are forwarded to them
+app.add_handler(ChatMemberUpdatedHandler(worker_pool.update_chat_member if WORKER_PROCESSES else update_chat_member))
+
+# Stats of the caches and the scheduler, exported on the metrics endpoint
+metrics.register_collector("message_cache", message_cache.stats)
+metrics.register_collector("member_cache", member_cache.stats)
+metrics.register_collector("telegraph_cache", telegraph_cache.stats)
+metrics.register_collector("scheduler", scheduler.stats)
+metrics.register_collector("workers", worker_pool.stats)
+metrics.register_collector("coalescer", coalescer.stats)
+metrics.register_collector("openai", openai_caller.breaker.stats)
+metrics.register_collector("context", lambda: {"tokens_saved_total": context_builder.tokens_saved_total})
+metrics.register_collector("function_result_cache", lambda: {
+    f"{called_function}_{name}": value
+    for called_function, function_stats in result_cache.stats().items() for name, value in function_stats.items()
+})
+
+logging.basicConfig(level=logging.INFO)
+# No secrets in the logs, whatever logger writes them
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(RedactingFilter(redactor))
+
+
+async def main():
+    # The openai lib reuses the pooled HTTP session instead of opening its own per request
+    openai.aiosession.set(http_client.session)
+    await metrics.start_server()
+    worker_pool.start()
+    try:
+        async with app:
+            await idle()
+            # The replies are sent through the app, so it is left only after the queued requests are handled
+            await scheduler.drain()
+    finally:
+        await worker_pool.stop()
+        await metrics.stop_server()
+        await http_client.close()
+
 
-# Run the Client
-app.run()
\ No newline at end of file
+# The worker processes import this module too, only the intake process runs the Client
+if __name__ == "__main__":
+    app.run(main())
\ No newline at end of file
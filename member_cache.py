@@ -0,0 +1,134 @@
+import asyncio
+import time
+from collections import OrderedDict
+from pyrogram.enums import ChatMembersFilter, ChatMemberStatus
+from pyrogram.types import ChatMemberUpdated
+from initialize_app import app
+
+
+# Seconds the chat member status is cached for, status changes delivered by Telegram invalidate it earlier
+MEMBER_STATUS_TTL = 600
+# Max number of cached (chat, user) statuses
+MEMBER_STATUS_CACHE_SIZE = 50000
+# If True, the administrators of a chat are fetched in the background on the first request in the chat
+PREWARM_ADMINISTRATORS = True
+
+
+class ChatMemberCache:
+    def __init__(self, ttl: float = MEMBER_STATUS_TTL, max_size: int = MEMBER_STATUS_CACHE_SIZE,
+                 prewarm_administrators: bool = PREWARM_ADMINISTRATORS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.prewarm_administrators = prewarm_administrators
+        # {(chat_id, user_id): (status, expiration time)}
+        self.statuses = OrderedDict()
+        self.prewarmed_chats = set()
+        # {(chat_id, user_id): future of the Telegram lookup in progress}, the concurrent misses await one lookup
+        self.lookups = {}
+        self.hits = 0
+        self.misses = 0
+        self._tasks = set()
+
+    def set(self, chat_id: int, user_id: int, status: ChatMemberStatus):
+        self.statuses[(chat_id, user_id)] = (status, time.monotonic() + self.ttl)
+        self.statuses.move_to_end((chat_id, user_id))
+        if len(self.statuses) > self.max_size:
+            self.statuses.popitem(last=False)
+
+    def invalidate(self, chat_id: int, user_id: int):
+        self.statuses.pop((chat_id, user_id), None)
+
+    def get(self, chat_id: int, user_id: int):
+        """
+        :return: The cached chat member status or None if it is not cached or expired.
+        """
+        status, expires = self.statuses.get((chat_id, user_id), (None, 0))
+        if status is None or expires < time.monotonic():
+            return None
+        return status
+
+    async def get_status(self, chat_id: int, user_id: int) -> ChatMemberStatus:
+        """
+        Gets the chat member status from the cache or, in case of a miss, from Telegram.
+        :return: The chat member status. Data type: pyrogram.enums.ChatMemberStatus.
+        """
+        status = self.get(chat_id, user_id)
+        if status is not None:
+            self.hits += 1
+            return status
+        self.misses += 1
+
+        if self.prewarm_administrators and chat_id not in self.prewarmed_chats:
+            self.prewarmed_chats.add(chat_id)
+            task = asyncio.create_task(self.prewarm(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        key = (chat_id, user_id)
+        lookup = self.lookups.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self.lookup(chat_id, user_id))
+            self.lookups[key] = lookup
+            lookup.add_done_callback(lambda _: self.lookups.pop(key, None))
+        return await asyncio.shield(lookup)
+
+    async def lookup(self, chat_id: int, user_id: int) -> ChatMemberStatus:
+        chat_member = await app.get_chat_member(chat_id, user_id)
+        self.set(chat_id, user_id, chat_member.status)
+        return chat_member.status
+
+    async def prewarm(self, chat_id: int):
+        """
+        Caches the statuses of all the chat administrators.
+        """
+        try:
+            async for chat_member in app.get_chat_members(chat_id, filter=ChatMembersFilter.ADMINISTRATORS):
+                self.set(chat_id, chat_member.user.id, chat_member.status)
+        except Exception:
+            # Prewarming is optional, the statuses will be fetched one by one
+            self.prewarmed_chats.discard(chat_id)
+
+    def stats(self):
+        """
+        :return: The cache counters. Data type: dict.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "statuses": len(self.statuses)
+        }
+
+
+def member_update(chat_member_updated: ChatMemberUpdated):
+    """
+    :return: (chat_id, user_id, new status or None if it is unknown) of the chat member status change,
+    None if the change has no user.
+    """
+    chat_id = chat_member_updated.chat.id
+    if chat_member_updated.new_chat_member and chat_member_updated.new_chat_member.user:
+        new_chat_member = chat_member_updated.new_chat_member
+        return chat_id, new_chat_member.user.id, new_chat_member.status
+    if chat_member_updated.old_chat_member and chat_member_updated.old_chat_member.user:
+        return chat_id, chat_member_updated.old_chat_member.user.id, None
+    return None
+
+
+def apply_member_update(chat_id: int, user_id: int, status: ChatMemberStatus = None):
+    if status is not None:
+        member_cache.set(chat_id, user_id, status)
+    else:
+        member_cache.invalidate(chat_id, user_id)
+
+
+async def update_chat_member(_, chat_member_updated: ChatMemberUpdated):
+    """
+    Updates the cached status, when Telegram delivers a chat member status change.
+    """
+    update = member_update(chat_member_updated)
+    if update is not None:
+        apply_member_update(*update)
+
+
+member_cache = ChatMemberCache()
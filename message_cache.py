@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from pyrogram.types import Message
+
+
+# Max number of messages kept in memory per chat
+MESSAGE_CACHE_SIZE = 2000
+# Max number of chats kept in memory
+MESSAGE_CACHE_CHATS = 500
+# Number of the latest message ids per chat, for which it is remembered whether the bot sent them
+SENT_MESSAGES_WINDOW = 16384
+# Max number of chats, which sent message ids are kept in memory
+SENT_MESSAGES_CHATS = 10000
+
+
+class SentMessageIndex:
+    """
+    Ids of the messages sent by the bot, per chat. Each chat keeps a ring bitset over its latest
+    SENT_MESSAGES_WINDOW message ids (2 KB with the default window), older ids are forgotten.
+    """
+    def __init__(self, window: int = SENT_MESSAGES_WINDOW, max_chats: int = SENT_MESSAGES_CHATS):
+        self.window = window
+        self.max_chats = max_chats
+        # {chat_id: [max_message_id, bytearray bitset]}
+        self.chats = OrderedDict()
+        # Called with (chat_id, message_id) on every add. The worker processes report their sent messages
+        # to the intake process with it
+        self.on_add = None
+
+    def add(self, chat_id: int, message_id: int):
+        if self.on_add is not None:
+            self.on_add(chat_id, message_id)
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = [message_id, bytearray(self.window // 8)]
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        self.chats.move_to_end(chat_id)
+
+        max_id, bits = chat
+        if message_id <= max_id - self.window:
+            return
+        if message_id > max_id:
+            # Clearing the bits of the ids, which leave the window
+            if message_id - max_id >= self.window:
+                bits[:] = bytes(len(bits))
+            else:
+                for old_id in range(max_id + 1, message_id + 1):
+                    position = old_id % self.window
+                    bits[position >> 3] &= ~(1 << (position & 7)) & 0xFF
+            chat[0] = message_id
+
+        position = message_id % self.window
+        bits[position >> 3] |= 1 << (position & 7)
+
+    def contains(self, chat_id: int, message_id: int) -> bool:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return False
+        max_id, bits = chat
+        if not max_id - self.window < message_id <= max_id:
+            return False
+        position = message_id % self.window
+        return bool(bits[position >> 3] & (1 << (position & 7)))
+
+
+class MessageCache:
+    def __init__(self, max_messages: int = MESSAGE_CACHE_SIZE, max_chats: int = MESSAGE_CACHE_CHATS):
+        self.max_messages = max_messages
+        self.max_chats = max_chats
+        # {chat_id: OrderedDict({message_id: Message})}, both levels are kept in LRU order
+        self.chats = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, message: Message):
+        """
+        Adds the message and all the messages it is replying to (already fetched by pyrogram) to the cache.
+        The messages sent by the bot are also added to the sent messages index.
+        :param message: The pyrogram message object.
+        """
+        while message and message.chat and message.id:
+            chat_messages = self.chats.get(message.chat.id)
+            if chat_messages is None:
+                chat_messages = self.chats[message.chat.id] = OrderedDict()
+                if len(self.chats) > self.max_chats:
+                    self.chats.popitem(last=False)
+            else:
+                self.chats.move_to_end(message.chat.id)
+
+            chat_messages[message.id] = message
+            chat_messages.move_to_end(message.id)
+            if len(chat_messages) > self.max_messages:
+                chat_messages.popitem(last=False)
+
+            if message.from_user and message.from_user.is_self:
+                sent_messages.add(message.chat.id, message.id)
+
+            message = message.reply_to_message
+
+    def get(self, chat_id: int, message_id: int):
+        """
+        Gets the message from the cache.
+        :return: The pyrogram message object or None in case of a miss.
+        """
+        chat_messages = self.chats.get(chat_id)
+        message = chat_messages.get(message_id) if chat_messages else None
+        if message is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        chat_messages.move_to_end(message_id)
+        return message
+
+    def stats(self):
+        """
+        :return: The cache counters. Data type: dict.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "chats": len(self.chats),
+            "messages": sum(len(chat_messages) for chat_messages in self.chats.values())
+        }
+
+
+async def cache_message(_, message: Message):
+    """
+    Adds every received message to the cache. Registered in a handler group running before the request handler.
+    """
+    message_cache.add(message)
+
+
+sent_messages = SentMessageIndex()
+message_cache = MessageCache()
@@ -1,66 +1,162 @@
 from config import MAX_FUNCTION_CALLS, OPENAI_API_KEY
-from list_gpt_functions import gpt3_functions
-from telegraph import TelegraphPage
+from function_registry import function_registry
+from record_store import records
 from telegram_api_execution import telegram_api_execution
 import openai
-from initialize_app import app
 from gpt import GPT
 from functioncall import FunctionCall
+from message_cache import message_cache
+from member_cache import member_cache
+from context_builder import context_builder
+from progressive_reply import ProgressiveReply
+from rate_limits import send_limiter
+from metrics import metrics
+from redaction import redactor
+from coalescer import batch_user_input
+from bulk_moderation import is_detached
+from router import model_router
+from resilience import OpenAIUnavailable, deadline_passed, request_deadline
+import asyncio
+import logging
 import re
+import time
 
 openai.api_key = OPENAI_API_KEY
 
+logger = logging.getLogger(__name__)
 
-async def handle_message(_, message):
+# If True, GPT responses are streamed: the reply is sent with the first tokens and edited while the answer grows
+STREAM_REPLIES = True
+# Answer when OpenAI didn't answer within the request deadline or after all the retries
+OPENAI_UNAVAILABLE_TEXT = "Sorry, I can't answer right now, please try again later."
+
+
+async def execute_function_call(message, user_statuses: list, called_function: str, params, error_msg: str):
     """
-    Handles the request message. Sends the request to GPT-3 and executes the Telegram API function calls. 
-    After each function call, the response or error is posted on Telegraph. And the Telegraph URL is added to the answer message text.
-    Then the answer message is sent back to the user.
+    Executes one function call of GPT response.
+    :param user_statuses: The statuses of the request senders, one per message of a coalesced request.
+    Data type: list of pyrogram.enums.ChatMemberStatus.
+    :return: The result or, in case of an error while handling the function call or executing it, the error.
     """
-    user_input = message.text
-    chat_id = message.chat.id
-    chat_member = await app.get_chat_member(chat_id, message.from_user.id)
-    user_status = chat_member.status
-    answer_text = ''
-    i = 0
-    called_function = "start"
+    # Check if the users have permission to use the function
+    if not error_msg and not all(function_registry.get(called_function).allows(user_status)
+                                 for user_status in user_statuses):
+        error_msg = "The user doesn't have permission to use this function."
+    # GPT gets the error instead of the result, so the loop ends with its next request failing on the deadline too
+    if not error_msg and deadline_passed():
+        error_msg = "The request deadline has passed, the function wasn't called. "
+
+    # Executing the Telegram API function call if no error occurred while handling the function call and arguments
+    if not error_msg:
+        function_call = FunctionCall(called_function, params, message)
+        with metrics.span("function_call", function=called_function):
+            result, error_msg = await function_call.execute()
+    return error_msg if error_msg else result
 
-    gpt = GPT(user_input, message)
-    await gpt.get_context(get_replies=True)
 
-    while i <= MAX_FUNCTION_CALLS and called_function:
-        i += 1
-        # Creating the GPT response
-        # (to_do) LATER HAVE TO IMPLEMENT EDITING FUNCTIONS BASED ON THE USER STATUS
-        openai_response = await gpt.acreate(
-            functions=gpt3_functions if i != MAX_FUNCTION_CALLS else [],
-            context=gpt.context,
-            function_call="auto" if i != MAX_FUNCTION_CALLS else "none"
-        )
-    
+async def handle_message(_, message, batched_messages: list = None):
+    """
+    Handles the request message. Sends the request to GPT-3 and executes the Telegram API function calls.
+    The triggers coalesced with the message (batched_messages, sent before it) are answered in the same reply,
+    the functions are limited to the ones all their senders can call.
+    All the function calls GPT makes in one response are executed concurrently.
+    After each function call, the response or error is stored as a record (local store or Telegraph). And the record URL is added to the answer message text.
+    Then the answer message is sent back to the user. With STREAM_REPLIES it is sent as soon as GPT starts answering
+    and edited while the answer is streamed.
+    """
+    # The deadline limits the whole GPT/function call loop: the OpenAI requests, the function calls with the bulk job wait,
+    # the record writes and the intermediate edits of the streamed reply. The final reply is sent also after it
+    with metrics.request_span(message.chat.id), request_deadline():
+        chat_id = message.chat.id
+        request_messages = [*(batched_messages or []), message]
+        user_input = batch_user_input(request_messages) if batched_messages else message.text
+        with metrics.span("member_lookup"):
+            user_statuses = await asyncio.gather(*(
+                member_cache.get_status(chat_id, request_message.from_user.id) for request_message in request_messages
+            ))
+        functions = function_registry.functions_for_all(user_statuses)
+        answer_text = ''
+        openai_requests = 0
+        tool_calls = ["start"]
+
+        gpt = GPT(user_input, message)
+        # The route picks the functions subset and the model by the request text and its reply chain
+        route = model_router.route(user_input, functions, await gpt.get_replies_context_history())
+        gpt.model = route.model
+        await gpt.get_context(get_replies=True)
+        progressive_reply = ProgressiveReply(message)
+        loop_started = time.perf_counter()
 
-        called_function, params, error_msg = await gpt.handle_function_call(openai_response)
+        # The loop ends as soon as GPT answers without calling functions. MAX_FUNCTION_CALLS only caps the rounds:
+        # the last allowed round gets no functions, so GPT has to answer
+        try:
+            while tool_calls:
+                openai_requests += 1
+                # Creating the GPT response
+                # Only the routed functions, which the user is allowed to call, are passed to GPT
+                round_functions = route.functions if openai_requests < MAX_FUNCTION_CALLS else []
+                if STREAM_REPLIES:
+                    # The hidden record links are kept at the beginning of the streamed answer.
+                    # A secret split between the chunks is held back until it is complete and can be redacted
+                    openai_response = await gpt.acreate_stream(
+                        functions=round_functions,
+                        context=gpt.context,
+                        on_content=lambda content: progressive_reply.update(redactor.redact_partial(answer_text + content)),
+                        function_call="auto" if round_functions else "none",
+                        model=route.model
+                    )
+                else:
+                    openai_response = await gpt.acreate(
+                        functions=round_functions,
+                        context=gpt.context,
+                        function_call="auto" if round_functions else "none",
+                        model=route.model
+                    )
 
-        if called_function:
-            # Executing the Telegram API function call if no error occurred while handling the function call and arguments
-            if not error_msg:
-                function_call = FunctionCall(called_function, params, message)
-                result, error_msg = await function_call.execute()
-            function_response = error_msg if error_msg else result
+                tool_calls = await gpt.handle_tool_calls(openai_response)
 
-            # Posting the Telegram API call and response or error on Telegraph 
-            url = await TelegraphPage(called_function, params, function_response).post_telegraph_page()
-            print(url)
-            # Adding the Telegraph URL to the answer message text
-            answer_text += f'[‎ ]({url})'
-            # Adding the response or error to the messages list
-            gpt.add_to_context([
-                openai_response['choices'][0]['message'],
-                {"role": "function", "name": called_function, "content": str(function_response)}])
-        else:
-            # Adding GPT's response to the answer message text
-            answer_text += openai_response['choices'][0]['message']['content']
+                if tool_calls:
+                    # Executing all the Telegram API function calls of the response concurrently
+                    with metrics.span("function_calls"):
+                        function_responses = await asyncio.gather(*(
+                            execute_function_call(message, user_statuses, called_function, params, error_msg)
+                            for _, called_function, params, error_msg in tool_calls
+                        ))
 
-    # Sending GPT-3's response back to the user
-    await message.reply(text=answer_text, disable_web_page_preview=True)
+                    # Storing the Telegram API calls and responses or errors (local store or Telegraph) concurrently.
+                    # The detached bulk jobs store only their summary records, when they finish
+                    with metrics.span("record_write"):
+                        urls = await asyncio.gather(*(
+                            records.write(called_function, params, function_response)
+                            for (_, called_function, params, _), function_response in zip(tool_calls, function_responses)
+                            if not is_detached(function_response)
+                        ))
+                    logger.debug("Function call records: %s", urls)
+                    # Adding the record URLs to the answer message text, in the order GPT called the functions
+                    answer_text += ''.join(f'[‎ ]({url})' for url in urls)
+                    # Adding the responses or errors to the messages list, hiding the secrets and truncating the oversized ones
+                    gpt.add_to_context([
+                        openai_response['choices'][0]['message'],
+                        *({"role": "tool", "tool_call_id": tool_call_id,
+                           "content": context_builder.truncate_function_result(redactor.redact(str(function_response)),
+                                                                               gpt.model)}
+                          for (tool_call_id, *_), function_response in zip(tool_calls, function_responses))
+                    ])
+                else:
+                    # Adding GPT's response to the answer message text
+                    answer_text += openai_response['choices'][0]['message']['content'] or ''
+        except OpenAIUnavailable as e:
+            # The answer keeps the record links of the functions already called
+            logger.warning("No GPT answer in chat %s: %s", chat_id, e)
+            answer_text += OPENAI_UNAVAILABLE_TEXT
+        model_router.record(route, loop_started, openai_requests)
 
+        # Sending GPT-3's response back to the user, or finishing the streamed reply. Secrets echoed by GPT are hidden
+        answer_text = redactor.redact(answer_text)
+        with metrics.span("final_reply"):
+            if progressive_reply.started:
+                answer_message = await progressive_reply.finish(answer_text)
+            else:
+                await send_limiter.acquire(chat_id)
+                answer_message = await message.reply(text=answer_text, disable_web_page_preview=True)
+        message_cache.add(answer_message)
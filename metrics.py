@@ -0,0 +1,181 @@
+import contextvars
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from aiohttp import web
+
+
+# Local address of the Prometheus-style metrics endpoint, None not to start it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+# Requests slower than this are logged with their span tree, None not to log them
+SLOW_REQUEST_SECONDS = 10
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def format_tree(self, indent: int = 0) -> str:
+        labels = ", ".join(f"{key}={value}" for key, value in self.labels.items())
+        line = f"{'  ' * indent}{self.name}{f' ({labels})' if labels else ''}: {self.duration * 1000:.1f} ms"
+        return "\n".join([line, *(child.format_tree(indent + 1) for child in self.children)])
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # {labels: [bucket counts..., +Inf count]}
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        self.counts[key][bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def export(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def export(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items())
+        return lines
+
+
+def format_labels(key: tuple, **extra) -> str:
+    labels = [*key, *extra.items()]
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """
+    Per-stage timing spans, OpenAI token usage and the counters of the caches, exported in the Prometheus text format.
+    """
+    def __init__(self, slow_request_seconds: float = SLOW_REQUEST_SECONDS):
+        self.slow_request_seconds = slow_request_seconds
+        self.stage_seconds = Histogram("gptmoder_stage_seconds", "Duration of the request handling stages.")
+        self.openai_tokens = CounterMetric("gptmoder_openai_tokens_total", "OpenAI tokens used, per chat and model.")
+        self.counters = {}
+        self.histograms = {}
+        # {name: callable returning {metric name: value}}, polled on export
+        self.collectors = {}
+        self.current_span = contextvars.ContextVar("current_span", default=None)
+        self._runner = None
+
+    def counter(self, name: str, help_text: str) -> CounterMetric:
+        if name not in self.counters:
+            self.counters[name] = CounterMetric(name, help_text)
+        return self.counters[name]
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = STAGE_BUCKETS) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help_text, buckets)
+        return self.histograms[name]
+
+    def register_collector(self, name: str, collector):
+        """
+        Registers the stats source. It is called on every export and returns {metric name: numeric value}.
+        """
+        self.collectors[name] = collector
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Times the stage. Spans opened inside another span (also in the tasks started inside it) become its children.
+        The duration is observed in the gptmoder_stage_seconds histogram by the stage name.
+        """
+        span = Span(name, labels)
+        parent = self.current_span.get()
+        if parent is not None:
+            parent.children.append(span)
+        token = self.current_span.set(span)
+        try:
+            yield span
+        finally:
+            self.current_span.reset(token)
+            span.duration = time.perf_counter() - span.start
+            self.stage_seconds.observe(span.duration, stage=name)
+
+    @contextmanager
+    def request_span(self, chat_id: int):
+        """
+        The root span of the request. Slow requests are logged with their span tree.
+        """
+        with self.span("request") as span:
+            yield span
+        if self.slow_request_seconds is not None and span.duration >= self.slow_request_seconds:
+            logger.warning("Slow request in chat %s:\n%s", chat_id, span.format_tree())
+
+    def record_usage(self, chat_id: int, model: str, usage: dict):
+        """
+        Counts the tokens from the 'usage' of OpenAI response.
+        """
+        if not usage:
+            return
+        self.openai_tokens.inc(usage.get("prompt_tokens", 0), chat_id=chat_id, model=model, kind="prompt")
+        self.openai_tokens.inc(usage.get("completion_tokens", 0), chat_id=chat_id, model=model, kind="completion")
+
+    def export(self) -> str:
+        lines = [*self.stage_seconds.export(), *self.openai_tokens.export()]
+        for counter in self.counters.values():
+            lines.extend(counter.export())
+        for histogram in self.histograms.values():
+            lines.extend(histogram.export())
+        for collector_name, collector in self.collectors.items():
+            for metric_name, value in collector().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"gptmoder_{collector_name}_{metric_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.export(), content_type="text/plain")
+
+    async def start_server(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        if port is None:
+            return
+        application = web.Application()
+        application.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(application)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
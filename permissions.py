@@ -2,7 +2,9 @@ from pyrogram.enums import ChatMemberStatus
 
 # Permissions and Secure Params Dict
 permissions = {
-    ChatMemberStatus.OWNER: {'getChatMemberCount', 'setChatDescription'},
-    ChatMemberStatus.ADMINISTRATOR: {'getChatMemberCount', 'setChatDescription'},
+    ChatMemberStatus.OWNER: {'getChatMemberCount', 'setChatDescription', 'banChatMembers', 'restrictChatMembers',
+                             'deleteMessagesRange'},
+    ChatMemberStatus.ADMINISTRATOR: {'getChatMemberCount', 'setChatDescription', 'banChatMembers',
+                                     'restrictChatMembers', 'deleteMessagesRange'},
     ChatMemberStatus.MEMBER: {'getChatMemberCount'}
 }
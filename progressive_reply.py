@@ -0,0 +1,110 @@
+import asyncio
+from pyrogram.errors import BadRequest, FloodWait, MessageNotModified
+from pyrogram.types import Message
+from rate_limits import send_limiter
+from resilience import deadline_passed
+
+
+# Min seconds between two intermediate edits of the streamed reply, keeps the edits under Telegram rate limits
+STREAM_EDIT_INTERVAL = 1.5
+
+
+class ProgressiveReply:
+    """
+    Reply, which is sent with the first streamed tokens and then edited while the text grows. Text updates are
+    coalesced: at most one intermediate edit per STREAM_EDIT_INTERVAL, always with the latest text. Intermediate edits
+    are skipped when the chat has no send budget left or the request deadline has passed. The final edit is sent
+    right away, it only waits for the send budget.
+    """
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.text = ''
+        self.sent_text = None
+        self.reply_message = None
+        self._next_flush_time = None
+        self._flush_task = None
+        # True while the scheduled edit is waiting, so it can be cancelled without interrupting a send
+        self._waiting = False
+
+    @property
+    def started(self):
+        return self._next_flush_time is not None
+
+    def update(self, text: str):
+        """
+        Sets the new text of the reply. It is sent by the next scheduled edit.
+        :param text: The whole text of the reply, not only the new part.
+        """
+        if not text:
+            return
+        self.text = text
+        if self._next_flush_time is None:
+            # The first tokens are sent right away, only the following edits are throttled
+            self._next_flush_time = asyncio.get_running_loop().time()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text: str):
+        """
+        Sends the final text of the reply without waiting for the edit interval, so the answer isn't finished late.
+        The scheduled intermediate edit is cancelled, an edit being sent is waited for.
+        :return: The reply message with the final text.
+        """
+        self.text = text
+        self._cancel_waiting_flush()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._flush(final=True)
+        return self.reply_message
+
+    def _cancel_waiting_flush(self):
+        if self._waiting and self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+            self._waiting = False
+
+    async def _flush_later(self):
+        delay = self._next_flush_time - asyncio.get_running_loop().time()
+        if delay > 0:
+            self._waiting = True
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._waiting = False
+        await self._flush(final=False)
+
+    async def _flush(self, final: bool):
+        while self.text != self.sent_text:
+            if final:
+                await send_limiter.acquire(self.message.chat.id)
+            elif deadline_passed() or not send_limiter.try_acquire(self.message.chat.id):
+                # No send budget left in the chat or no time left, the text will be sent by the next or the final edit
+                return
+
+            text = self.text
+            try:
+                if self.reply_message is None:
+                    self.reply_message = await self.message.reply(text=text, disable_web_page_preview=True)
+                else:
+                    # The edited message is kept, so the returned reply has the final text, not the first part
+                    self.reply_message = await self.reply_message.edit_text(text, disable_web_page_preview=True)
+                self.sent_text = text
+            except FloodWait as e:
+                if not final:
+                    self._next_flush_time = asyncio.get_running_loop().time() + e.value
+                    return
+                await asyncio.sleep(e.value)
+                continue
+            except MessageNotModified:
+                self.reply_message.text = text
+                self.sent_text = text
+            except BadRequest:
+                # Intermediate texts can contain unclosed markdown, they are skipped
+                if final:
+                    raise
+            finally:
+                self._next_flush_time = max(self._next_flush_time, asyncio.get_running_loop().time() + self.interval)
+
+            if not final:
+                return
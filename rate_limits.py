@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+# OpenAI rate limits of the account
+OPENAI_REQUESTS_PER_MINUTE = 3500
+OPENAI_TOKENS_PER_MINUTE = 90000
+# Tokens reserved for the completion, when a request is budgeted before its usage is known
+OPENAI_COMPLETION_TOKENS_ESTIMATE = 500
+# Telegram limits for sending and editing messages: per chat and for the whole bot
+TELEGRAM_SENDS_PER_MINUTE_PER_CHAT = 20
+TELEGRAM_SENDS_PER_SECOND = 30
+# Max number of chats, which send budgets are kept in memory
+TELEGRAM_SEND_BUDGET_CHATS = 10000
+
+
+class TokenBucket:
+    """
+    Token bucket: refills with rate tokens per second up to capacity. The balance can go below zero
+    when the actually used amount turns out bigger than the acquired one, then the next acquirers wait longer.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """
+        Takes the amount of tokens if they are available right now.
+        :return: True if the tokens were taken.
+        """
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    async def acquire(self, amount: float = 1):
+        """
+        Waits until the amount of tokens is available and takes it. Amounts bigger than capacity are capped.
+        """
+        amount = min(amount, self.capacity)
+        # The lock makes the waiters take the tokens in the order they came
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float):
+        """
+        Corrects the balance by the difference between the used and the acquired amount.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class OpenAILimiter:
+    """
+    Keeps the OpenAI requests within the requests per minute and tokens per minute limits.
+    """
+    def __init__(self, requests_per_minute: int = OPENAI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = OPENAI_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+
+    async def acquire(self, prompt_tokens: int):
+        """
+        Waits for the budget of one request with the prompt_tokens prompt.
+        :return: The number of acquired tokens, to be passed to used() when the usage is known.
+        """
+        tokens = prompt_tokens + OPENAI_COMPLETION_TOKENS_ESTIMATE
+        await self.requests.acquire()
+        await self.tokens.acquire(tokens)
+        return tokens
+
+    def used(self, acquired_tokens: int, used_tokens: int):
+        self.tokens.adjust(used_tokens - acquired_tokens)
+
+
+class SendLimiter:
+    """
+    Keeps sending and editing messages within the Telegram limits: per chat and for the whole bot.
+    """
+    def __init__(self, per_minute_per_chat: int = TELEGRAM_SENDS_PER_MINUTE_PER_CHAT,
+                 per_second: int = TELEGRAM_SENDS_PER_SECOND, max_chats: int = TELEGRAM_SEND_BUDGET_CHATS):
+        self.per_minute_per_chat = per_minute_per_chat
+        self.max_chats = max_chats
+        self.total = TokenBucket(per_second, per_second)
+        self.chats = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(self.per_minute_per_chat / 60, self.per_minute_per_chat)
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        self.chats.move_to_end(chat_id)
+        return bucket
+
+    def try_acquire(self, chat_id: int) -> bool:
+        """
+        Takes the budget of one message if it is available right now. Used for the sends, which can be skipped.
+        """
+        bucket = self._chat_bucket(chat_id)
+        if bucket.try_acquire():
+            if self.total.try_acquire():
+                return True
+            bucket.adjust(-1)
+        return False
+
+    async def acquire(self, chat_id: int):
+        """
+        Waits for the budget of one message in the chat.
+        """
+        await self._chat_bucket(chat_id).acquire()
+        await self.total.acquire()
+
+
+openai_limiter = OpenAILimiter()
+send_limiter = SendLimiter()
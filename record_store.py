@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from telegraph import TelegraphPage
+from resilience import attempt_timeout
+
+
+# Backend storing the function call records: "sqlite" (local store) or "telegraph"
+RECORD_BACKEND = "sqlite"
+# Path of the local SQLite store
+RECORD_DB_PATH = "records.sqlite3"
+# Local records are linked in the messages as RECORD_URL_PREFIX + record id
+RECORD_URL_PREFIX = "https://telegram.me/GPTModerBot?record="
+TELEGRAPH_URL_PREFIX = "https://telegra.ph"
+# If True, local records are also published on Telegraph in the background
+TELEGRAPH_MIRROR = False
+# Retries of a failed local record write, with exponential backoff. Until it is written, the record is served from memory
+RECORD_WRITE_RETRIES = 3
+RECORD_WRITE_RETRY_DELAY = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def parse_record_value(value: str):
+    """
+    Parses the stored params or result. Data type: dict/str (in case of errors)
+    """
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return str(value)
+
+
+class SQLiteRecordStore:
+    """
+    Local function call records store. Records are written in the background, a record can be linked in the message
+    right away, because its id is generated locally. Not yet written records are served from memory.
+    """
+    def __init__(self, path: str = RECORD_DB_PATH, telegraph_mirror: bool = TELEGRAPH_MIRROR):
+        self.path = path
+        self.telegraph_mirror = telegraph_mirror
+        self._connection = None
+        self._lock = threading.Lock()
+        # {record_id: (called_function, params, result)} of the records, which are not written yet
+        self.pending = {}
+        self._tasks = set()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id TEXT PRIMARY KEY, called_function TEXT NOT NULL, params TEXT NOT NULL, result TEXT NOT NULL, "
+                "telegraph_url TEXT, created_at REAL NOT NULL)"
+            )
+        return self._connection
+
+    def _insert(self, record_id: str, called_function: str, params: str, result: str):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO records (id, called_function, params, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (record_id, called_function, params, result, time.time())
+                )
+
+    def _set_telegraph_url(self, record_id: str, url: str):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("UPDATE records SET telegraph_url = ? WHERE id = ?", (url, record_id))
+
+    def _select(self, record_ids: list):
+        with self._lock:
+            placeholders = ", ".join("?" * len(record_ids))
+            return self._connect().execute(
+                f"SELECT id, called_function, params, result FROM records WHERE id IN ({placeholders})", record_ids
+            ).fetchall()
+
+    def _run_in_background(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        # Keeping the reference, so the task is not garbage collected before it is done
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, record_id: str, called_function: str, params: str, result: str):
+        """
+        Writes the record, retrying the failed inserts. A record, which couldn't be written, stays pending,
+        so it is still readable while the bot runs.
+        """
+        for retry in range(RECORD_WRITE_RETRIES + 1):
+            try:
+                await asyncio.to_thread(self._insert, record_id, called_function, params, result)
+                break
+            except Exception:
+                if retry == RECORD_WRITE_RETRIES:
+                    logger.exception("Failed to write the record %s of %s, it is kept in memory only",
+                                     record_id, called_function)
+                    return
+                logger.warning("Failed to write the record %s of %s, retrying", record_id, called_function,
+                               exc_info=True)
+                await asyncio.sleep(RECORD_WRITE_RETRY_DELAY * 2 ** retry)
+        self.pending.pop(record_id, None)
+
+        if self.telegraph_mirror:
+            try:
+                url = await TelegraphPage(called_function, params, result).post_telegraph_page()
+                await asyncio.to_thread(self._set_telegraph_url, record_id, url)
+            except Exception:
+                logger.exception("Failed to mirror the record %s on Telegraph", record_id)
+
+    def write(self, called_function: str, params: str, result: str):
+        """
+        Schedules writing of the record.
+        :param params: The formatted parameters of the function call.
+        :param result: The formatted result of the function call.
+        :return: The id of the record.
+        """
+        record_id = secrets.token_hex(8)
+        self.pending[record_id] = (called_function, params, result)
+        self._run_in_background(self._write(record_id, called_function, params, result))
+        return record_id
+
+    async def read_many(self, record_ids: list):
+        """
+        Reads the records with a single query.
+        :return: {record_id: (called_function, params, result)}. Data type: dict.
+        """
+        records = {record_id: self.pending[record_id] for record_id in record_ids if record_id in self.pending}
+        missing_ids = [record_id for record_id in record_ids if record_id not in records]
+        if missing_ids:
+            for record_id, called_function, params, result in await asyncio.to_thread(self._select, missing_ids):
+                records[record_id] = (called_function, params, result)
+
+        return {
+            record_id: (called_function, parse_record_value(params), parse_record_value(result))
+            for record_id, (called_function, params, result) in records.items()
+        }
+
+
+class RecordStore:
+    """
+    Stores the function call records on the configured backend and reads them back by the URLs hidden in the messages.
+    Both kinds of URLs are always readable, so the records written before switching the backend stay available.
+    """
+    def __init__(self, backend: str = RECORD_BACKEND):
+        if backend not in ("sqlite", "telegraph"):
+            raise ValueError(f"RecordStore: Unknown backend {backend}, expected 'sqlite' or 'telegraph'")
+        self.backend = backend
+        # Also used with the Telegraph backend to read the records written before switching the backend
+        self.sqlite = SQLiteRecordStore()
+
+    @staticmethod
+    def is_record_url(url: str):
+        return url.startswith(TELEGRAPH_URL_PREFIX) or url.startswith(RECORD_URL_PREFIX)
+
+    async def write(self, called_function: str, params, result):
+        """
+        Writes the function call record.
+        :param called_function: The called function.
+        :param params: The parameters of the function call. Data type: dict/str (in case of errors)
+        :param result: The result of the function call. Data type: dict/str (in case of errors)
+        :return: The URL of the record.
+        """
+        if self.backend == "telegraph":
+            try:
+                return await asyncio.wait_for(TelegraphPage(called_function, params, result).post_telegraph_page(),
+                                              attempt_timeout())
+            except asyncio.TimeoutError:
+                # Past the request deadline the record is stored locally, its URL is known right away
+                pass
+
+        page = TelegraphPage()
+        params = page.hide_vulnerable_data(page.to_format(params))
+        result = page.hide_vulnerable_data(page.to_format(result))
+        return RECORD_URL_PREFIX + self.sqlite.write(called_function, params, result)
+
+    async def read_many(self, urls: list):
+        """
+        Reads the records of all the URLs at once: the local records with a single query,
+        the Telegraph pages concurrently.
+        :return: {url: (called_function, params, result)}. Data type: dict.
+        """
+        record_ids = {url: url[len(RECORD_URL_PREFIX):] for url in urls if url.startswith(RECORD_URL_PREFIX)}
+        telegraph_urls = [url for url in urls if url.startswith(TELEGRAPH_URL_PREFIX)]
+
+        records = {}
+        if record_ids:
+            local_records = await self.sqlite.read_many(list(set(record_ids.values())))
+            records.update({url: local_records[record_id] for url, record_id in record_ids.items()
+                            if record_id in local_records})
+        if telegraph_urls:
+            records.update(await TelegraphPage.read_telegraph_pages(telegraph_urls))
+        return records
+
+
+records = RecordStore()
@@ -0,0 +1,93 @@
+import logging
+import re
+from config import VULNERABLE_DATA
+
+
+REDACTION_MASK = "********"
+
+
+def trie_pattern(words: list) -> str:
+    """
+    Builds a regex matching any of the words, structured as a trie: the alternatives of every node start with
+    different characters, so at each text position the regex follows one path of at most the longest word length.
+    Optional groups are greedy, so the longest matching word wins.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def node_pattern(node: dict) -> str:
+        is_end = "" in node
+        branches = [re.escape(char) + node_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + pattern + ")?" if is_end else pattern
+
+    return node_pattern(trie)
+
+
+class Redactor:
+    """
+    Replaces all the secrets in a text in a single pass. The secrets are compiled once into a trie-structured regex.
+    """
+    def __init__(self, secrets: list, mask: str = REDACTION_MASK):
+        self.mask = mask
+        secrets = {str(secret) for secret in secrets if str(secret)}
+        self.pattern = re.compile(trie_pattern(sorted(secrets))) if secrets else None
+        # All the beginnings of the secrets, to hold them back at the end of a text, which is still growing
+        self.prefixes = {secret[:length] for secret in secrets for length in range(1, len(secret) + 1)}
+        self.max_length = max(map(len, secrets), default=0)
+
+    def redact(self, text: str) -> str:
+        if not isinstance(text, str):
+            raise TypeError(f"Expected str, got {type(text)}")
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.mask, text)
+
+    def redact_partial(self, text: str) -> str:
+        """
+        Redacts the text, which can still grow, e.g. a streamed answer. The end of the text, which can be
+        the beginning of a secret, is held back until the text continues.
+        """
+        if self.pattern is None:
+            return self.redact(text)
+        cut = len(text)
+        for length in range(min(self.max_length, len(text)), 0, -1):
+            if text[-length:] in self.prefixes:
+                cut -= length
+                break
+        # A secret crossing the cut is redacted as a whole
+        for match in self.pattern.finditer(text):
+            if match.start() < cut < match.end():
+                cut = match.end()
+        return self.redact(text[:cut])
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Redacts the secrets in the log records, also in their exception tracebacks and stack info.
+    Attached to the log handlers, so it covers the records of all the loggers.
+    """
+    def __init__(self, redactor: Redactor):
+        super().__init__()
+        self.redactor = redactor
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = self.redactor.redact(record.getMessage())
+        record.args = ()
+        # The formatters use the cached exc_text instead of formatting exc_info again
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redactor.redact(record.exc_text)
+        if record.stack_info:
+            record.stack_info = self.redactor.redact(record.stack_info)
+        return True
+
+
+redactor = Redactor(VULNERABLE_DATA)
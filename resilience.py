@@ -0,0 +1,304 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+import openai
+from metrics import metrics
+
+
+# Seconds one request may spend in the GPT/function call loop, None for no deadline
+REQUEST_DEADLINE = 90
+# Seconds one OpenAI attempt may take. For the streams: to the first chunk and between the chunks
+OPENAI_ATTEMPT_TIMEOUT = 30
+# Retries of a failed OpenAI request, with jittered exponential backoff or the Retry-After of the response
+OPENAI_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+# If True, a second identical request is sent when the first one takes longer than the p95 latency of the model.
+# The slower one is cancelled
+HEDGING_ENABLED = False
+HEDGE_MIN_DELAY = 1.0
+# Latencies of the last LATENCY_WINDOW requests per model are kept, hedging starts after HEDGE_MIN_SAMPLES of them
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# Consecutive failures opening the circuit of a model. While it is open, the requests go to FALLBACK_MODEL,
+# after CIRCUIT_OPEN_SECONDS one request tries the model again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 30
+# Secondary model, None not to fall back
+FALLBACK_MODEL = None
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+logger = logging.getLogger(__name__)
+
+# Absolute time.monotonic() deadline of the request being handled, None if it has none
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class OpenAIUnavailable(Exception):
+    """
+    Raised when the OpenAI request failed after all the retries or the request deadline has passed.
+    """
+
+
+@contextmanager
+def request_deadline(seconds: float = REQUEST_DEADLINE):
+    """
+    Sets the deadline of everything called inside, also in the tasks started inside.
+    """
+    token = current_deadline.set(time.monotonic() + seconds if seconds is not None else None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining_time():
+    """
+    :return: Seconds left to the deadline or None if there is no deadline.
+    """
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def attempt_timeout(timeout: float = None):
+    """
+    :return: The timeout, shortened to the time left to the deadline. None if there is neither.
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def deadline_passed() -> bool:
+    """
+    :return: True if the deadline of the request being handled has passed.
+    """
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def retry_after(error: Exception):
+    """
+    :return: Seconds from the Retry-After header of the OpenAI error response or None.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class LatencyTracker:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        # {model: deque of the latest latencies}
+        self.latencies = {}
+
+    def observe(self, model: str, seconds: float):
+        self.latencies.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, percent: float = 95, min_samples: int = HEDGE_MIN_SAMPLES):
+        """
+        :return: The nearest-rank percentile of the model latencies or None if there are fewer than min_samples.
+        """
+        latencies = self.latencies.get(model)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, open_seconds: float = CIRCUIT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        # {model: consecutive failures}
+        self.failures = {}
+        # {model: time.monotonic() the circuit was opened at}
+        self.opened = {}
+
+    def allows(self, model: str) -> bool:
+        """
+        :return: False while the circuit of the model is open. After open_seconds one request is let through,
+        its result closes the circuit or opens it again.
+        """
+        opened = self.opened.get(model)
+        if opened is None:
+            return True
+        if time.monotonic() - opened >= self.open_seconds:
+            self.opened[model] = time.monotonic()
+            return True
+        return False
+
+    def success(self, model: str):
+        self.failures.pop(model, None)
+        self.opened.pop(model, None)
+
+    def failure(self, model: str):
+        self.failures[model] = self.failures.get(model, 0) + 1
+        if self.failures[model] >= self.failure_threshold and model not in self.opened:
+            self.opened[model] = time.monotonic()
+            metrics.counter("gptmoder_openai_circuit_opened_total", "Circuits opened, per model.").inc(model=model)
+            logger.warning("OpenAI circuit of %s is open after %s failures", model, self.failures[model])
+
+    def stats(self):
+        """
+        :return: The number of models with open circuits. Data type: dict.
+        """
+        return {"open_circuits": len(self.opened)}
+
+
+class ResilientCaller:
+    """
+    Runs the OpenAI requests with the attempt timeout and the request deadline, retries the transient errors,
+    optionally hedges the slow requests and falls back to the secondary model while the circuit of the model is open.
+    """
+    def __init__(self, attempt_timeout: float = OPENAI_ATTEMPT_TIMEOUT, max_retries: int = OPENAI_MAX_RETRIES,
+                 hedging: bool = HEDGING_ENABLED, fallback_model: str = FALLBACK_MODEL):
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.hedging = hedging
+        self.fallback_model = fallback_model
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+        self.retries = metrics.counter("gptmoder_openai_retries_total", "OpenAI requests retried, per model and error.")
+        self.hedges = metrics.counter("gptmoder_openai_hedges_total", "OpenAI requests hedged, per model and winner.")
+        self.fallbacks = metrics.counter("gptmoder_openai_fallbacks_total",
+                                         "OpenAI requests sent to the fallback model, per model.")
+        self.failures = metrics.counter("gptmoder_openai_failures_total",
+                                        "OpenAI requests given up, per model and reason.")
+
+    def timeout(self):
+        """
+        :return: Seconds the current attempt may take, shortened to the time left to the deadline.
+        """
+        return attempt_timeout(self.attempt_timeout)
+
+    def model_for(self, model: str) -> str:
+        """
+        :return: The model or, while its circuit is open, the fallback model.
+        """
+        if self.breaker.allows(model) or not self.fallback_model or self.fallback_model == model:
+            return model
+        self.fallbacks.inc(model=model, fallback=self.fallback_model)
+        return self.fallback_model
+
+    async def call(self, attempt, model: str, stream: bool = False, acquire=None):
+        """
+        :param attempt: async function(model, budget) sending one request.
+        :param stream: If True, the attempt is limited only by the deadline, as its chunks are timed by the attempt
+        itself with timeout(). And it is never hedged: two streams would both update the reply.
+        :param acquire: async function() -> budget, waiting for the local rate limit budget of one request.
+        It is awaited before each attempt, outside of the attempt timeout and limited only by the deadline:
+        waiting for the budget is not a failure of the model. The budget is passed to the attempt.
+        :return: The result of the first successful attempt.
+        :raises OpenAIUnavailable: If all the attempts failed or the deadline has passed.
+        """
+        for retry in range(self.max_retries + 1):
+            attempt_model = self.model_for(model)
+            budget = await self._acquire(acquire, attempt_model)
+
+            started = time.perf_counter()
+            try:
+                if self.hedging and not stream:
+                    result = await self._hedged(attempt, attempt_model, budget, acquire, self.timeout())
+                else:
+                    result = await asyncio.wait_for(attempt(attempt_model, budget),
+                                                    attempt_timeout() if stream else self.timeout())
+            except RETRYABLE_ERRORS as e:
+                self.breaker.failure(attempt_model)
+                delay = retry_after(e)
+                delay = (delay if delay is not None else 0) + random.uniform(
+                    0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry))
+                remaining = remaining_time()
+                if retry == self.max_retries or (remaining is not None and delay >= remaining):
+                    self.failures.inc(model=attempt_model, reason=type(e).__name__)
+                    raise OpenAIUnavailable(f"OpenAI request failed: {type(e).__name__}: {e}") from e
+                self.retries.inc(model=attempt_model, error=type(e).__name__)
+                logger.info("OpenAI request to %s failed with %s, retrying in %.1f s", attempt_model,
+                            type(e).__name__, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            self.breaker.success(attempt_model)
+            # The hedging delay is based on the latencies of the whole responses, the streams last as long as the answer
+            if not stream:
+                self.latency.observe(attempt_model, time.perf_counter() - started)
+            return result
+
+    async def _acquire(self, acquire, model: str):
+        """
+        Waits for the budget of one attempt until the deadline.
+        :return: The budget or None without 'acquire'.
+        :raises OpenAIUnavailable: If the deadline has passed.
+        """
+        if not deadline_passed():
+            if acquire is None:
+                return None
+            try:
+                return await asyncio.wait_for(acquire(), remaining_time())
+            except asyncio.TimeoutError:
+                pass
+        self.failures.inc(model=model, reason="deadline")
+        raise OpenAIUnavailable("The request deadline has passed")
+
+    async def _hedged(self, attempt, model: str, budget=None, acquire=None, timeout: float = None):
+        """
+        Sends the request and, if it isn't answered within the p95 latency of the model, the same request again.
+        The first successful one wins, the other one is cancelled. The second request waits for its own budget.
+        """
+        hedge_delay = self.latency.percentile(model)
+        if hedge_delay is None:
+            return await asyncio.wait_for(attempt(model, budget), timeout)
+        hedge_delay = max(HEDGE_MIN_DELAY, hedge_delay)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        async def hedge():
+            return await attempt(model, await acquire() if acquire is not None else None)
+
+        first = asyncio.create_task(attempt(model, budget))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay if timeout is None else min(hedge_delay, timeout))
+            hedged = not done and (deadline is None or time.monotonic() < deadline)
+            if hedged:
+                tasks.add(asyncio.create_task(hedge()))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=None if deadline is None else max(0, deadline - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if hedged:
+                            self.hedges.inc(model=model, winner="first" if task is first else "hedge")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+openai_caller = ResilientCaller()
@@ -0,0 +1,107 @@
+import json
+import re
+import time
+from context_builder import context_builder
+from metrics import metrics
+from redaction import trie_pattern
+from routing_rules import function_keywords, moderation_keywords, route_models
+
+
+# If False, every request gets all the allowed functions and the default model
+ROUTING_ENABLED = True
+DEFAULT_MODEL = "gpt-3.5-turbo"
+ROUTE_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def keywords_pattern(keywords: set):
+    """
+    :return: The compiled regex matching any of the keywords as whole words, ignoring case. None if there are none.
+    """
+    if not keywords:
+        return None
+    return re.compile(r"\b(?:" + trie_pattern(sorted(keyword.lower() for keyword in keywords)) + r")\b", re.IGNORECASE)
+
+
+class Route:
+    def __init__(self, name: str, model: str, functions: list, tokens_saved: int = 0):
+        self.name = name
+        self.model = model
+        # The schemas of the functions passed to GPT, empty for the plain questions
+        self.functions = functions
+        # Prompt tokens of the function schemas left out of each OpenAI request of the route
+        self.tokens_saved = tokens_saved
+
+
+class ModelRouter:
+    """
+    Decides, which functions and which model the request gets, with keyword heuristics from routing_rules.py:
+    - 'tools': the request mentions particular functions and has no other moderation intent, only they are passed;
+    - 'all_tools': the request has a moderation intent or continues a conversation with function calls,
+    all the allowed functions are passed. A request asking for a function and for another moderation action
+    ("kick them and tell me how many members remain") gets all of them too;
+    - 'plain': anything else, no functions are passed and the model can be a cheaper one.
+    """
+    def __init__(self, function_keywords: dict = function_keywords, moderation_keywords: set = moderation_keywords,
+                 route_models: dict = route_models, default_model: str = DEFAULT_MODEL, enabled: bool = ROUTING_ENABLED):
+        self.function_patterns = {name: keywords_pattern(keywords) for name, keywords in function_keywords.items()}
+        self.moderation_pattern = keywords_pattern(moderation_keywords)
+        self.route_models = route_models
+        self.default_model = default_model
+        self.enabled = enabled
+        self.decisions = metrics.counter("gptmoder_route_decisions_total", "Routing decisions, per route and model.")
+        self.tokens_saved = metrics.counter("gptmoder_route_tokens_saved_total",
+                                            "Prompt tokens of the function schemas not sent thanks to routing, per route.")
+        self.seconds = metrics.histogram("gptmoder_route_seconds", "Duration of the GPT loop, per route and model.",
+                                         ROUTE_BUCKETS)
+
+    def model_for(self, route_name: str) -> str:
+        return self.route_models.get(route_name) or self.default_model
+
+    def route(self, user_input: str, functions: list, history: list = None) -> Route:
+        """
+        :param user_input: The request text.
+        :param functions: The schemas of the functions the user is allowed to call.
+        :param history: The replies context history of the request.
+        :return: The route of the request.
+        """
+        if not self.enabled or not functions:
+            route = Route("all_tools" if functions else "plain", self.default_model, functions)
+        else:
+            user_input = user_input or ''
+            matched = [function for function in functions
+                       if self.function_patterns.get(function["name"])
+                       and self.function_patterns[function["name"]].search(user_input)]
+            continues_function_calls = any(context_message.get("tool_calls") for context_message in history or [])
+
+            moderation_intent = bool(self.moderation_pattern and self.moderation_pattern.search(user_input))
+
+            if continues_function_calls or moderation_intent:
+                route_name, route_functions = "all_tools", functions
+            elif matched:
+                route_name, route_functions = "tools", matched
+            else:
+                route_name, route_functions = "plain", []
+
+            model = self.model_for(route_name)
+            tokens_saved = sum(self.count_schema_tokens(function, model)
+                               for function in functions if function not in route_functions)
+            route = Route(route_name, model, route_functions, tokens_saved)
+
+        self.decisions.inc(route=route.name, model=route.model)
+        return route
+
+    @staticmethod
+    def count_schema_tokens(function: dict, model: str) -> int:
+        return context_builder.counter.count_text(json.dumps(function), model, key=("schema", function["name"]))
+
+    def record(self, route: Route, started: float, openai_requests: int):
+        """
+        Records the GPT loop of the routed request: its duration since 'started' (time.perf_counter())
+        and the schema tokens saved in all its OpenAI requests.
+        """
+        self.seconds.observe(time.perf_counter() - started, route=route.name, model=route.model)
+        if route.tokens_saved:
+            self.tokens_saved.inc(route.tokens_saved * openai_requests, route=route.name)
+
+
+model_router = ModelRouter()
@@ -0,0 +1,23 @@
+# Keywords of the requests needing the function, matched as whole words ignoring case.
+# Only the matched functions are passed to GPT
+function_keywords = {
+    'getChatMemberCount': {'member', 'members', 'member count', 'how many', 'count', 'people', 'users', 'participants'},
+    'setChatDescription': {'description', 'describe the chat', 'chat bio', 'about section'},
+    'banChatMembers': {'ban', 'spam wave', 'spammers'},
+    'restrictChatMembers': {'mute', 'restrict', 'read-only', 'read only'},
+    'deleteMessagesRange': {'delete messages', 'clean up', 'cleanup', 'purge'},
+}
+
+# Keywords of the moderation requests: all the allowed functions are passed, also if some function keywords match,
+# as the request can ask for more actions than the matched functions do
+moderation_keywords = {
+    'ban', 'unban', 'kick', 'mute', 'unmute', 'restrict', 'delete', 'remove', 'pin', 'unpin', 'warn', 'promote',
+    'demote', 'set', 'change', 'update', 'edit', 'rename',
+}
+
+# Models per route, None to use the default model
+route_models = {
+    'plain': None,
+    'tools': None,
+    'all_tools': None,
+}
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from collections import deque, defaultdict
+from pyrogram.types import Message
+from rate_limits import send_limiter
+
+
+# Max number of requests handled at the same time, in all the chats
+MAX_CONCURRENT_REQUESTS = 16
+# Max number of requests handled at the same time in one chat
+MAX_CONCURRENT_REQUESTS_PER_CHAT = 1
+# Max number of requests waiting in one chat and in all the chats, the requests above are rejected
+MAX_QUEUED_REQUESTS_PER_CHAT = 5
+MAX_QUEUED_REQUESTS = 200
+BUSY_TEXT = "I'm busy with other requests right now, please try again in a minute."
+
+logger = logging.getLogger(__name__)
+
+
+class RequestScheduler:
+    """
+    Runs the request handler with concurrency limits: in total and per chat. The chats are served in round-robin order,
+    so a burst of requests in one chat doesn't delay the other chats. The queues are bounded, when they are full
+    the request is rejected with BUSY_TEXT.
+    """
+    def __init__(self, handler, max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+                 max_concurrent_per_chat: int = MAX_CONCURRENT_REQUESTS_PER_CHAT,
+                 max_queued_per_chat: int = MAX_QUEUED_REQUESTS_PER_CHAT, max_queued: int = MAX_QUEUED_REQUESTS):
+        self.handler = handler
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_chat = max_concurrent_per_chat
+        self.max_queued_per_chat = max_queued_per_chat
+        self.max_queued = max_queued
+        # {chat_id: deque([(client, message, args), ...])}
+        self.pending = {}
+        # Chat ids with pending requests, in the order they are served
+        self.ready = deque()
+        self.running = defaultdict(int)
+        self.queued = 0
+        self.rejected = 0
+        self._condition = None
+        self._workers = []
+
+    def _start(self):
+        self._condition = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def submit(self, client, message: Message, *args):
+        """
+        Queues the request. Registered as the pyrogram handler instead of the request handler itself.
+        :param args: Passed to the handler after the message, e.g. the earlier messages of a coalesced batch.
+        """
+        if self._condition is None:
+            self._start()
+
+        chat_id = message.chat.id
+        chat_pending = self.pending.get(chat_id)
+        if self.queued >= self.max_queued or (chat_pending and len(chat_pending) >= self.max_queued_per_chat):
+            self.rejected += 1
+            # Rejecting is optional work, so it is skipped if the chat has no send budget left
+            if send_limiter.try_acquire(chat_id):
+                await message.reply(text=BUSY_TEXT)
+            return
+
+        async with self._condition:
+            if chat_pending is None:
+                chat_pending = self.pending[chat_id] = deque()
+                self.ready.append(chat_id)
+            chat_pending.append((client, message, args))
+            self.queued += 1
+            self._condition.notify()
+
+    def _next_request(self):
+        """
+        Takes the next request of the first ready chat, which is under its concurrency limit.
+        The chat is moved to the end of the ready queue.
+        :return: (chat_id, client, message, args) or None if there is no request to run.
+        """
+        for _ in range(len(self.ready)):
+            chat_id = self.ready.popleft()
+            if self.running[chat_id] >= self.max_concurrent_per_chat:
+                self.ready.append(chat_id)
+                continue
+
+            chat_pending = self.pending[chat_id]
+            client, message, args = chat_pending.popleft()
+            if chat_pending:
+                self.ready.append(chat_id)
+            else:
+                del self.pending[chat_id]
+            self.queued -= 1
+            self.running[chat_id] += 1
+            return chat_id, client, message, args
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                chat_id, client, message, args = await self._condition.wait_for(self._next_request)
+
+            try:
+                await self.handler(client, message, *args)
+            except Exception:
+                logger.exception("Request handling failed in chat %s", chat_id)
+            finally:
+                async with self._condition:
+                    self.running[chat_id] -= 1
+                    if not self.running[chat_id]:
+                        del self.running[chat_id]
+                    # The chat can have requests waiting for this one to finish
+                    self._condition.notify_all()
+
+    async def drain(self):
+        """
+        Waits until all the queued and running requests are handled.
+        """
+        if self._condition is None:
+            return
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self.queued and not self.running)
+
+    def stats(self):
+        """
+        :return: The scheduler counters. Data type: dict.
+        """
+        return {
+            "queued": self.queued,
+            "running": sum(self.running.values()),
+            "rejected": self.rejected,
+            "chats_waiting": len(self.ready)
+        }
@@ -1,8 +1,8 @@
 # Secure Parameters Class (chat_id, etc.)
 class SecureParameters:
-    def __init__(self, called_function, message):
+    def __init__(self, required_spm: list, message):
         self.message = message
-        self.required_spm = function_required_spm.get(called_function, [])
+        self.required_spm = required_spm
         self.secure_params = {}
 
     def get_all(self):
@@ -18,4 +18,7 @@ class SecureParameters:
 function_required_spm = {
     'getChatMemberCount': [SecureParameters.get_chat_id],
     'setChatDescription': [SecureParameters.get_chat_id],
+    'banChatMembers': [SecureParameters.get_chat_id],
+    'restrictChatMembers': [SecureParameters.get_chat_id],
+    'deleteMessagesRange': [SecureParameters.get_chat_id],
 }
@@ -1,8 +1,9 @@
 import aiohttp
 import json
 from config import TELEGRAM_TOKEN
-from secure_parameters import SecureParameters
-from permissions import permissions
+from function_registry import function_registry
+from initialize_app import http_client
+from functioncall import TELEGRAM_API_URL
 
 
 async def telegram_api_execution(message, user_status, called_function, params):
@@ -18,25 +19,25 @@ async def telegram_api_execution(message, user_status, called_function, params):
     try:
 
         # Check if the user has permission to use the function
-        if called_function in permissions.get(user_status, set()):
+        function = function_registry.get(called_function)
+        if function and function.allows(user_status):
 
             
             # Telegram API URL
-            telegram_api_url = f'https://api.telegram.org/bot{TELEGRAM_TOKEN}/{called_function}'
+            telegram_api_url = f'{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/{called_function}'
             # Get the secure parameters (chat_id, etc.)
-            secure_params = SecureParameters(called_function, message).get_all()
+            secure_params = function.secure_params(message)
             params.update(secure_params)
             
-            async with aiohttp.ClientSession() as session:
-                try:
-                    # Send the request to the Telegram API
-                    async with session.post(telegram_api_url, json=params) as resp:
-                        resp.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
-                        result = await resp.json()
-                except aiohttp.ClientResponseError as e:
-                    error = f"HTTP error occurred: {e.status}"
-                except json.JSONDecodeError as e:
-                    error = f"JSON decode error occurred: {e}"
+            try:
+                # Send the request to the Telegram API
+                async with http_client.session.post(telegram_api_url, json=params) as resp:
+                    resp.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
+                    result = await resp.json()
+            except aiohttp.ClientResponseError as e:
+                error = f"HTTP error occurred: {e.status}"
+            except json.JSONDecodeError as e:
+                error = f"JSON decode error occurred: {e}"
         else:
             error = "The user doesn't have permission to use this function."
     except Exception as e:
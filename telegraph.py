@@ -1,8 +1,101 @@
-import aiohttp
+import asyncio
 import json
+import logging
+import os
+import re
 import secrets
 import datetime
-from config import TELEGRAPH_TOKEN, VULNERABLE_DATA
+from collections import OrderedDict
+from config import TELEGRAPH_TOKEN
+from redaction import redactor
+from initialize_app import http_client
+
+
+logger = logging.getLogger(__name__)
+
+# Telegraph API base URL
+TELEGRAPH_API_URL = "https://api.telegra.ph"
+# Max number of page contents kept in memory
+TELEGRAPH_CACHE_SIZE = 5000
+# Directory for the on-disk cache tier, None to keep the cache in memory only
+TELEGRAPH_CACHE_DIR = None
+# Max number of pages read from Telegraph at the same time
+TELEGRAPH_MAX_PARALLEL_READS = 8
+
+
+class TelegraphCache:
+    """
+    Cache of Telegraph page contents keyed by page path. Published pages never change, so entries never expire,
+    they are only evicted in LRU order. Evicted entries stay available in the optional on-disk tier.
+    """
+    def __init__(self, max_size: int = TELEGRAPH_CACHE_SIZE, cache_dir: str = TELEGRAPH_CACHE_DIR):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _disk_path(self, path: str):
+        return os.path.join(self.cache_dir, re.sub(r'[^\w\-]', '_', path) + '.txt')
+
+    def _read_disk(self, path: str):
+        try:
+            with open(self._disk_path(path), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, path: str, content: str):
+        with open(self._disk_path(path), 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def _remember(self, path: str, content: str):
+        self.pages[path] = content
+        self.pages.move_to_end(path)
+        if len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+
+    async def get(self, path: str):
+        """
+        Gets the page content from memory, then from disk.
+        :return: The page content or None in case of a miss.
+        """
+        content = self.pages.get(path)
+        if content is not None:
+            self.hits += 1
+            self.pages.move_to_end(path)
+            return content
+
+        if self.cache_dir:
+            content = await asyncio.to_thread(self._read_disk, path)
+            if content is not None:
+                self.disk_hits += 1
+                self._remember(path, content)
+                return content
+
+        self.misses += 1
+        return None
+
+    async def set(self, path: str, content: str):
+        self._remember(path, content)
+        if self.cache_dir:
+            await asyncio.to_thread(self._write_disk, path, content)
+
+    def stats(self):
+        """
+        :return: The cache counters. Data type: dict.
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "pages": len(self.pages)
+        }
 
 
 class TelegraphPage:
@@ -20,13 +113,8 @@ class TelegraphPage:
         return a
     
     def hide_vulnerable_data(self, a: str):
-        if not isinstance(a, str):
-            raise TypeError(f"Expected str, got {type(a)}")
-        
-        for data in VULNERABLE_DATA:
-            a = a.replace(str(data), "********")
-            
-        return a
+        # All the VULNERABLE_DATA is replaced in a single pass, see redaction.py
+        return redactor.redact(a)
     
     async def post_telegraph_page(self):
         """
@@ -39,49 +127,75 @@ class TelegraphPage:
         if not self.called_function:
             return
 
-        print(self.called_function, self.params, self.result)
         self.result = self.hide_vulnerable_data(self.to_format(self.result))
         self.params = self.hide_vulnerable_data(self.to_format(self.params))
-        print(self.called_function, self.params, self.result)
-
-
-        async with aiohttp.ClientSession() as session:
-            response = await session.post(
-                'https://api.telegra.ph/createPage',
-                json={
-                    "access_token": TELEGRAPH_TOKEN,
-                    "title": f"Request #{secrets.token_hex(8)} ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})",
-                    "author_name": "GPTModerBot",
-                    "author_url": "https://telegram.me/GPTModerBot",
-                    "content": [f"{self.called_function}\n\n{self.params}\n\n{self.result}"]
-                }
-            )
-        data = await response.json()
+        logger.debug("Posting Telegraph page: %s %s %s", self.called_function, self.params, self.result)
+        content = f"{self.called_function}\n\n{self.params}\n\n{self.result}"
+
+        async with http_client.session.post(
+            f'{TELEGRAPH_API_URL}/createPage',
+            json={
+                "access_token": TELEGRAPH_TOKEN,
+                "title": f"Request #{secrets.token_hex(8)} ({datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})",
+                "author_name": "GPTModerBot",
+                "author_url": "https://telegram.me/GPTModerBot",
+                "content": [content]
+            }
+        ) as response:
+            data = await response.json()
         self.url = data["result"]["url"]
+        # Published pages never change, so the content can be cached right away
+        await telegraph_cache.set(self.url.split("/")[-1], content)
         return self.url
 
 
     async def read_telegraph_page(self):
         """
         Reads a Telegraph page and returns the called function, parameters and result.
+        The page content is taken from the cache if possible.
         :param url: The URL of the Telegraph page.
         :return: The called function, parameters and result. Data type: str, dict/str (in case of errors), dict/str (in case of errors)
         """
         if not self.url:
             return
         
-        async with aiohttp.ClientSession() as session:
-            response = await session.get(f'https://api.telegra.ph/getPage/{self.url.split("/")[-1]}?return_content=true')
-            data = await response.json()
+        path = self.url.split("/")[-1]
+        content = await telegraph_cache.get(path)
+        if content is None:
+            async with http_client.session.get(f'{TELEGRAPH_API_URL}/getPage/{path}?return_content=true') as response:
+                data = await response.json()
             content = data['result']['content'][0]
-            self.called_function, params, result = content.split('\n\n')
-            
-            try:
-                self.params = json.loads(params)
-            except json.JSONDecodeError:
-                self.params = str(params)
-            try:
-                self.resul = json.loads(result)
-            except json.JSONDecodeError:
-                self.result = str(result)
-            return self.called_function, self.params, self.result
+            await telegraph_cache.set(path, content)
+
+        self.called_function, params, result = content.split('\n\n')
+        
+        try:
+            self.params = json.loads(params)
+        except json.JSONDecodeError:
+            self.params = str(params)
+        try:
+            self.result = json.loads(result)
+        except json.JSONDecodeError:
+            self.result = str(result)
+        return self.called_function, self.params, self.result
+
+    @staticmethod
+    async def read_telegraph_pages(urls: list, max_parallel: int = TELEGRAPH_MAX_PARALLEL_READS):
+        """
+        Reads several Telegraph pages concurrently, with at most max_parallel requests at the same time.
+        :param urls: The URLs of the Telegraph pages.
+        :param max_parallel: The max number of pages read at the same time.
+        :return: {url: (called_function, params, result)}. Data type: dict.
+        """
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def read(url):
+            async with semaphore:
+                return await TelegraphPage(url=url).read_telegraph_page()
+
+        unique_urls = list(dict.fromkeys(urls))
+        pages = await asyncio.gather(*(read(url) for url in unique_urls))
+        return dict(zip(unique_urls, pages))
+
+
+telegraph_cache = TelegraphCache()
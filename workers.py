@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import openai
+from pyrogram.types import ChatMemberUpdated, Message
+from initialize_app import app, http_client, WORKER_ENV
+from message_handler import handle_message
+from message_cache import message_cache, sent_messages
+from member_cache import member_cache, member_update, apply_member_update
+from metrics import metrics, METRICS_PORT
+from rate_limits import send_limiter
+from scheduler import RequestScheduler, BUSY_TEXT
+import bulk_moderation
+
+
+# Number of worker processes handling the requests, 0 to handle them in the intake process
+WORKER_PROCESSES = 0
+# Max number of requests waiting in the queue of one worker, the requests above are rejected
+WORKER_QUEUE_SIZE = 500
+# Seconds a worker has on shutdown to finish its queued requests, the intake process waits a bit longer for it to exit
+WORKER_SHUTDOWN_TIMEOUT = 30
+WORKER_EXIT_GRACE = 10
+# Seconds to wait for a place in a full worker queue for a chat member update, which can't be dropped
+MEMBER_UPDATE_PUT_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    Splits the update intake from the request processing. The intake process only queues the triggered requests,
+    the worker processes run the GPT/function call loop. The requests are sharded by chat_id, so the requests of
+    one chat are always handled by the same worker in the order they came. Every worker has its own pyrogram session
+    to fetch the messages and send the replies.
+    The chat member updates go to the worker of the chat through the same queue, so its member status cache
+    is invalidated before the next request of the chat. The workers report the ids of the messages they send
+    back to the intake process, where the trigger filter looks them up.
+    """
+    def __init__(self, processes: int = WORKER_PROCESSES, queue_size: int = WORKER_QUEUE_SIZE):
+        self.processes_count = processes
+        self.queue_size = queue_size
+        self.queues = []
+        self.processes = []
+        self.events = None
+        self.rejected = 0
+        self._events_task = None
+
+    def start(self):
+        if not self.processes_count:
+            return
+        # Spawned processes don't inherit the event loop and the connections of the intake process
+        context = multiprocessing.get_context("spawn")
+        self.events = context.Queue()
+        for index in range(self.processes_count):
+            worker_queue = context.Queue(self.queue_size)
+            # The environment is copied on spawn, so the worker imports initialize_app with its own session
+            os.environ[WORKER_ENV] = str(index)
+            try:
+                process = context.Process(target=run_worker, args=(index, worker_queue, self.events),
+                                          name=f"gptmoder-worker-{index}", daemon=True)
+                process.start()
+            finally:
+                del os.environ[WORKER_ENV]
+            self.queues.append(worker_queue)
+            self.processes.append(process)
+        self._events_task = asyncio.create_task(self._receive_events())
+
+    def worker_queue(self, chat_id: int):
+        return self.queues[chat_id % self.processes_count]
+
+    async def submit(self, _, message: Message, batched_messages: list = None):
+        """
+        Queues the request to the worker of the chat. Registered as the pyrogram handler in the intake process.
+        Only the message ids are queued, also of the coalesced batched_messages.
+        """
+        chat_id = message.chat.id
+        batched_ids = [batched_message.id for batched_message in batched_messages or []]
+        try:
+            self.worker_queue(chat_id).put_nowait(("request", chat_id, message.id, batched_ids))
+        except queue.Full:
+            self.rejected += 1
+            if send_limiter.try_acquire(chat_id):
+                await message.reply(text=BUSY_TEXT)
+
+    async def update_chat_member(self, _, chat_member_updated: ChatMemberUpdated):
+        """
+        Forwards the chat member status change to the worker of the chat. Registered as the pyrogram handler
+        in the intake process.
+        """
+        update = member_update(chat_member_updated)
+        if update is None:
+            return
+        try:
+            await asyncio.to_thread(self.worker_queue(update[0]).put, ("member", *update), True,
+                                    MEMBER_UPDATE_PUT_TIMEOUT)
+        except queue.Full:
+            logger.error("Failed to forward the chat member update of user %s in chat %s", update[1], update[0])
+
+    async def _receive_events(self):
+        """
+        Applies the events reported by the workers until the None sentinel comes.
+        """
+        while True:
+            event = await asyncio.to_thread(self.events.get)
+            if event is None:
+                break
+            kind, chat_id, message_id = event
+            if kind == "sent":
+                sent_messages.add(chat_id, message_id)
+
+    async def stop(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join, WORKER_SHUTDOWN_TIMEOUT + WORKER_EXIT_GRACE)
+            if process.is_alive():
+                process.terminate()
+        if self._events_task is not None:
+            self.events.put(None)
+            await self._events_task
+
+    def stats(self):
+        """
+        :return: The pool counters. Data type: dict.
+        """
+        return {
+            "alive": sum(process.is_alive() for process in self.processes),
+            "rejected": self.rejected
+        }
+
+
+def run_worker(index: int, worker_queue, events):
+    """
+    The worker process entry point.
+    """
+    asyncio.run(process_requests(index, worker_queue, events))
+
+
+async def process_requests(index: int, worker_queue, events):
+    """
+    Handles the queued requests and chat member updates until the None sentinel comes. The request message is fetched
+    by the worker's own session, the per-chat order is kept by the scheduler. Before leaving, the requests already
+    queued in the scheduler and the background bulk jobs are finished.
+    Every worker exports its metrics on its own port: METRICS_PORT + 1 + index.
+    """
+    scheduler = RequestScheduler(handle_message)
+    openai.aiosession.set(http_client.session)
+    sent_messages.on_add = lambda chat_id, message_id: events.put(("sent", chat_id, message_id))
+
+    metrics.register_collector("message_cache", message_cache.stats)
+    metrics.register_collector("member_cache", member_cache.stats)
+    metrics.register_collector("scheduler", scheduler.stats)
+    await metrics.start_server(port=METRICS_PORT + 1 + index if METRICS_PORT is not None else None)
+    try:
+        async with app:
+            while True:
+                item = await asyncio.to_thread(worker_queue.get)
+                if item is None:
+                    break
+                if item[0] == "member":
+                    apply_member_update(*item[1:])
+                    continue
+
+                _, chat_id, message_id, batched_ids = item
+                try:
+                    messages = await app.get_messages(chat_id, [*batched_ids, message_id])
+                except Exception:
+                    logger.exception("Failed to fetch the request message %s in chat %s", message_id, chat_id)
+                    continue
+                messages = [message for message in messages if message and not message.empty]
+                if len(messages) > 1:
+                    await scheduler.submit(app, messages[-1], messages[:-1])
+                elif messages:
+                    await scheduler.submit(app, messages[0])
+
+            # The replies are sent through the app, so it is left only after the queued requests are handled
+            try:
+                await asyncio.wait_for(asyncio.gather(scheduler.drain(), *bulk_moderation.background_jobs),
+                                       WORKER_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Worker %s stopped with requests still running", index)
+    finally:
+        await metrics.stop_server()
+        await http_client.close()